@@ -8,8 +8,10 @@ import random
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
 from torch.utils.tensorboard import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks as comm_hooks
 import numpy as np
 import time
 import pprint
@@ -20,6 +22,7 @@ from utils import config, logger_tools, other_tools, metric, data_transfer, othe
 from dataloaders import data_tools
 import librosa
 from models.vq.intentional_tokenizer import IntentionalTokenizer
+from models.LSM import ConditionBatch
 import wandb
 import math
 from tqdm import tqdm
@@ -57,8 +60,17 @@ class CustomTrainer(train.BaseTrainer):
             self.model = getattr(model_module, cfg.model.g_name)(cfg).to(self.rank)
             process_group = torch.distributed.new_group()
             self.model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(self.model, process_group)   
+            # grads alias the all-reduce buckets (no grad<->bucket copies). The set of used parameters
+            # changes between steps (the intention pad token only gets a gradient when a sample has no
+            # intention; reflow skips the modality encoder), so unused parameters are searched for and
+            # the graph is not declared static unless ddp_static_graph asks for it
             self.model = DDP(self.model, device_ids=[self.rank], output_device=self.rank,
-                             broadcast_buffers=False, find_unused_parameters=False)
+                             broadcast_buffers=False, find_unused_parameters=self.cfg.get('ddp_find_unused', True),
+                             gradient_as_bucket_view=self.cfg.get('ddp_bucket_view', True),
+                             static_graph=self.cfg.get('ddp_static_graph', False))
+            if self.cfg.get('ddp_fp16_compress', False):
+                # halves all-reduce traffic; mainly worth it across nodes
+                self.model.register_comm_hook(None, comm_hooks.fp16_compress_hook)
         else: 
             self.model = torch.nn.DataParallel(getattr(model_module, cfg.model.g_name)(cfg), self.cfg.gpus).cuda()
         
@@ -120,7 +132,7 @@ class CustomTrainer(train.BaseTrainer):
         
         
         if self.args.checkpoint:
-            ckpt_state_dict = torch.load(self.args.checkpoint)['model_state_dict']
+            ckpt_state_dict = train.load_checkpoint_file(self.args.checkpoint)['model_state_dict']
             # remove 'audioEncoder' from the state_dict due to legacy issues
             ckpt_state_dict = {k: v for k, v in ckpt_state_dict.items() if 'modality_encoder.audio_encoder.' not in k}
             self.model.load_state_dict(ckpt_state_dict, strict=False)
@@ -129,32 +141,33 @@ class CustomTrainer(train.BaseTrainer):
     
     def _load_data(self, dict_data):
         audio_name = dict_data["audio_name"]
-        facial_rep = dict_data["facial"].to(self.rank)
-        beta = dict_data["beta"].to(self.rank)
-        tar_trans = dict_data["trans"].to(self.rank)
-        tar_id = dict_data["id"].to(self.rank)
-        cached_rep15d = dict_data["rep15d"].to(self.rank)
-        tar_pose = convert_15d_to_6d(dict_data["rep15d"]).to(self.rank)
+        facial_rep = dict_data["facial"].to(self.rank, non_blocking=True)
+        beta = dict_data["beta"].to(self.rank, non_blocking=True)
+        tar_trans = dict_data["trans"].to(self.rank, non_blocking=True)
+        tar_id = dict_data["id"].to(self.rank, non_blocking=True)
+        cached_rep15d = dict_data["rep15d"].to(self.rank, non_blocking=True)
+        tar_pose = convert_15d_to_6d(dict_data["rep15d"]).to(self.rank, non_blocking=True)
         cached_rep15d = (cached_rep15d - self.mean_pose) / self.std_pose
-        cached_audio_low = dict_data["audio_low"].to(self.rank) # (bs, T, C) C = 512
-        cached_audio_high = dict_data["audio_high"].to(self.rank) # (bs, T, C) C = 768
-        bert_time_aligned = dict_data["bert_time_aligned"].to(self.rank) # (bs, T, C) C = 768
+        cached_audio_low = dict_data["audio_low"].to(self.rank, non_blocking=True) # (bs, T, C) C = 512
+        cached_audio_high = dict_data["audio_high"].to(self.rank, non_blocking=True) # (bs, T, C) C = 768
+        bert_time_aligned = dict_data["bert_time_aligned"].to(self.rank, non_blocking=True) # (bs, T, C) C = 768
         
         intention_embeddings = dict_data.get("intention_embeddings", None)
         if intention_embeddings is not None:
-            intention_embeddings = intention_embeddings.to(self.rank)
+            # collated in the source dtype (fp16 from the memmap) or intention_dtype; upcast on device
+            intention_embeddings = intention_embeddings.to(self.rank, non_blocking=True).float()
         
         intention_mask = dict_data.get("intention_mask", None)
         if intention_mask is not None:
-            intention_mask = intention_mask.to(self.rank)
+            intention_mask = intention_mask.to(self.rank, non_blocking=True)
         
         audio_onset = None  
         if self.cfg.data.onset_rep:
-            audio_onset = dict_data["audio_onset"].to(self.rank)
+            audio_onset = dict_data["audio_onset"].to(self.rank, non_blocking=True)
             
         word = dict_data.get("word", None)
         if word is not None:
-            word = word.to(self.rank)
+            word = word.to(self.rank, non_blocking=True)
             
         # used during testing for time segment
         intention_timings = dict_data.get("intention_timings", None)
@@ -163,7 +176,7 @@ class CustomTrainer(train.BaseTrainer):
         
         cached_audio_high = torch.cat([cached_audio_high, bert_time_aligned], dim=-1) # [bs, T, C] C = 1536 (768 + 768)
         
-        audio_tensor = dict_data["audio_tensor"].to(self.rank) # (bs, T) T = 68266
+        audio_tensor = dict_data["audio_tensor"].to(self.rank, non_blocking=True) # (bs, T) T = 68266
         
         #TODO: I need to test whether postquantizer or prequantizer is better
         # default is postprojected
@@ -200,23 +213,32 @@ class CustomTrainer(train.BaseTrainer):
             "audio_name": audio_name,
         }
     
+    def _train_step_model(self):
+        """
+        Module to run a training step through. DDP is called itself so its forward prepares the
+        gradient all-reduce; DataParallel would split the batch (each replica sees a share of the
+        flow/consistency split) and gather per-replica loss vectors, so go through .module there.
+        """
+        return self.model if isinstance(self.model, DDP) else self.model.module
+
     def _g_training(self, loaded_data, mode="train", epoch=0):
             
-        cond_ = {'y':{}}
-        cond_['y']['audio_tensor'] = loaded_data['audio_tensor']
-        cond_['y']['audio_low'] = loaded_data['cached_audio_low']
-        cond_['y']['audio_high'] = loaded_data['cached_audio_high']
-        cond_['y']['audio_onset'] = loaded_data['audio_onset']
-        cond_['y']['word'] = loaded_data['word']
-        cond_['y']['id'] = loaded_data['tar_id']
-        cond_['y']['seed'] = loaded_data['latent_in'][:,:self.cfg.pre_frames]
-        cond_['y']['style_feature'] = loaded_data['style_feature']
-        cond_['y']['intention_embeddings'] = loaded_data['intention_embeddings']
-        cond_['y']['intention_mask'] = loaded_data['intention_mask']
+        cond_ = ConditionBatch(
+            audio_tensor=loaded_data['audio_tensor'],
+            audio_low=loaded_data['cached_audio_low'],
+            audio_high=loaded_data['cached_audio_high'],
+            audio_onset=loaded_data['audio_onset'],
+            word=loaded_data['word'],
+            id=loaded_data['tar_id'],
+            seed=loaded_data['latent_in'][:,:self.cfg.pre_frames],
+            style_feature=loaded_data['style_feature'],
+            intention_embeddings=loaded_data['intention_embeddings'],
+            intention_mask=loaded_data['intention_mask'],
+        )
         x0 = loaded_data['latent_in']
-        x0 = x0.permute(0, 2, 1).unsqueeze(2)
+        x0 = x0.permute(0, 2, 1)
 
-        g_loss_final = self.model.module.train_forward(cond_, x0, train_consistency=True)['loss']
+        g_loss_final = self._train_step_model()(cond_, x0, mode='train', train_consistency=True)['loss']
 
         self.tracker.update_meter("predict_x0_loss", "train", g_loss_final.item())
 
@@ -230,7 +252,7 @@ class CustomTrainer(train.BaseTrainer):
         noise = loaded_data['noise'].squeeze(0)
         seed = loaded_data['seed'].squeeze(0)
         
-        g_loss_final = self.model.module.train_reflow(latents, at_feat, noise, seed)['loss']
+        g_loss_final = self._train_step_model()(latents, at_feat, noise, seed, mode='reflow')['loss']
         self.tracker.update_meter("predict_x0_loss", "train", g_loss_final.item())  
         
         if mode == 'train':
@@ -388,21 +410,22 @@ class CustomTrainer(train.BaseTrainer):
                 loaded_data.get('intention_embedding_lengths', [[]])  # Assuming this is available
             )
             
-            cond_ = {'y':{}}
-            cond_['y']['audio_tensor'] = in_audio_tmp
-            cond_['y']['audio_low'] = in_audio_low_tmp
-            cond_['y']['audio_high'] = in_audio_high_tmp
-            cond_['y']['audio_onset'] = in_audio_onset_tmp
-            cond_['y']['word'] = in_word_tmp
-            cond_['y']['id'] = in_id_tmp
-            cond_['y']['seed'] = in_seed_tmp
-            cond_['y']['style_feature'] = torch.zeros([bs, 512]).cuda()
-            cond_['y']['intention_embeddings'] = relevant_embeddings
-            cond_['y']['intention_mask'] = relevant_mask
+            cond_ = ConditionBatch(
+                audio_tensor=in_audio_tmp,
+                audio_low=in_audio_low_tmp,
+                audio_high=in_audio_high_tmp,
+                audio_onset=in_audio_onset_tmp,
+                word=in_word_tmp,
+                id=in_id_tmp,
+                seed=in_seed_tmp,
+                style_feature=torch.zeros([bs, 512]).cuda(),
+                intention_embeddings=relevant_embeddings,
+                intention_mask=relevant_mask,
+            )
             
             sample = self.model(cond_)['latents']
             
-            sample = sample.squeeze(2).permute(0, 2, 1)
+            sample = sample.permute(0, 2, 1)
 
             last_sample = sample.clone()
             
@@ -456,6 +479,17 @@ class CustomTrainer(train.BaseTrainer):
 
         }
     
+    def _iter_test_outputs(self, loader):
+        """
+        Run _g_test per full-length test sequence and yield (net_out, loaded_data). The loader is
+        kept at batch_size=1: the VQ encoder/decoder attend over the whole, unmasked time axis, so
+        zero-padding sequences into one batch would change every shorter sample's output, and
+        _get_relevant_intentions reads the timings of the first sample only.
+        """
+        for batch_data in loader:
+            loaded_data = self._load_data(batch_data)
+            yield self._g_test(loaded_data), loaded_data
+
     def train(self, epoch):
 
         self.model.train()
@@ -467,7 +501,8 @@ class CustomTrainer(train.BaseTrainer):
     
             self.opt.zero_grad()
             g_loss_final = 0
-            g_loss_final += self._g_training(loaded_data, 'train', epoch)
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.use_amp):
+                g_loss_final += self._g_training(loaded_data, 'train', epoch)
 
             g_loss_final.backward()
             if self.cfg.solver.max_grad_norm != 0: 
@@ -498,7 +533,8 @@ class CustomTrainer(train.BaseTrainer):
     
             self.opt.zero_grad()
             g_loss_final = 0
-            g_loss_final += self._g_training_reflow(loaded_data, 'train', epoch)
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.use_amp):
+                g_loss_final += self._g_training_reflow(loaded_data, 'train', epoch)
 
             g_loss_final.backward()
             if self.cfg.solver.max_grad_norm != 0: 
@@ -519,7 +555,7 @@ class CustomTrainer(train.BaseTrainer):
         self.opt_s.step(epoch)
     
 
-    def val(self, epoch):
+    def val(self, epoch, iteration=None):
         
 
         self.tracker.reset()
@@ -535,11 +571,9 @@ class CustomTrainer(train.BaseTrainer):
         self.model.eval()
         self.smplx.eval()
         self.eval_copy.eval()
-        with torch.no_grad():
-            for its, batch_data in enumerate(self.test_loader):
-                bs = batch_data['rep15d'].shape[0]
-                loaded_data = self._load_data(batch_data)    
-                net_out = self._g_test(loaded_data)
+        with torch.inference_mode():
+            # val_loader holds this rank's shard of the test set under DDP, the whole set otherwise
+            for its, (net_out, loaded_data) in enumerate(self._iter_test_outputs(self.val_loader)):
                 tar_pose = net_out['tar_pose']
                 rec_pose = net_out['rec_pose']
                 tar_exps = net_out['tar_exps']
@@ -557,8 +591,8 @@ class CustomTrainer(train.BaseTrainer):
 
                 remain = n%self.cfg.vae_test_len
                 
-                latent_out.append(self.eval_copy.map2latent(rec_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy()) # bs * n/8 * 240
-                latent_ori.append(self.eval_copy.map2latent(tar_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy())
+                latent_out.append(self.eval_map2latent(rec_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy()) # bs * n/8 * 240
+                latent_ori.append(self.eval_map2latent(tar_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy())
                 
                 rec_pose = rc.rotation_6d_to_matrix(rec_pose.reshape(bs*n, j, 6))
                 rec_pose = rc.matrix_to_axis_angle(rec_pose).reshape(bs*n, j*3)
@@ -583,7 +617,7 @@ class CustomTrainer(train.BaseTrainer):
                 
                 _ = self.l1_calculator.run(joints_rec)
                 if self.alignmenter is not None:
-                    in_audio_eval, sr = librosa.load(self.cfg.data.data_path+"wave16k/"+test_seq_list.iloc[its]['id']+".wav")
+                    in_audio_eval, sr = librosa.load(self.cfg.data.data_path+"wave16k/"+test_seq_list.iloc[self.val_indices[its]]['id']+".wav")
                     in_audio_eval = librosa.resample(in_audio_eval, orig_sr=sr, target_sr=self.cfg.data.audio_sr)
                     a_offset = int(self.align_mask * (self.cfg.data.audio_sr / self.cfg.data.pose_fps))
                     onset_bt = self.alignmenter.load_audio(in_audio_eval[:int(self.cfg.data.audio_sr / self.cfg.data.pose_fps*n)], a_offset, len(in_audio_eval)-a_offset, True)
@@ -593,6 +627,17 @@ class CustomTrainer(train.BaseTrainer):
                 total_length += n
                 
 
+        l1_sum, l1_counter = self.l1_calculator.sum, self.l1_calculator.counter
+        if dist.is_initialized() and dist.get_world_size() > 1:
+            # reduce the per-rank partial sums; FGD needs every latent, so those are gathered
+            totals = torch.tensor([l2_all, lvel, align, total_length, l1_sum, l1_counter], dtype=torch.float64, device=self.rank)
+            dist.all_reduce(totals)
+            l2_all, lvel, align, total_length, l1_sum, l1_counter = totals.tolist()
+            gathered = [None] * dist.get_world_size()
+            dist.all_gather_object(gathered, (latent_out, latent_ori))
+            latent_out = [x for out, _ in gathered for x in out]
+            latent_ori = [x for _, ori in gathered for x in ori]
+
         logger.info(f"l2 loss: {l2_all/total_length:.10f}")
         logger.info(f"lvel loss: {lvel/total_length:.10f}")
 
@@ -603,22 +648,24 @@ class CustomTrainer(train.BaseTrainer):
         logger.info(f"fgd score: {fgd}")
         self.tracker.update_meter("fgd", "val", fgd)
         
-        align_avg = align/(total_length-2*len(self.test_loader)*self.align_mask)
+        align_avg = align/(total_length-2*len(self.test_data)*self.align_mask)
         logger.info(f"align score: {align_avg}")
         self.tracker.update_meter("bc", "val", align_avg)
         
-        l1div = self.l1_calculator.avg()
+        l1div = l1_sum / l1_counter
         logger.info(f"l1div score: {l1div}")
         self.tracker.update_meter("l1div", "val", l1div)
         
-        self.val_recording(epoch)
+        # every rank holds the reduced metrics, but only one writes checkpoints and logs
+        if not dist.is_initialized() or dist.get_rank() == 0:
+            self.val_recording(epoch, iteration)
 
         end_time = time.time() - start_time
         logger.info(f"total inference time: {int(end_time)} s for {int(total_length/self.cfg.data.pose_fps)} s motion")
     
     
     
-    def test_clip(self, epoch):
+    def test_clip(self, epoch, iteration=None):
         
 
         self.tracker.reset()
@@ -634,7 +681,7 @@ class CustomTrainer(train.BaseTrainer):
         self.model.eval()
         self.smplx.eval()
         self.eval_copy.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             for its, batch_data in enumerate(tqdm(self.test_clip_loader, desc="Testing CLIP", leave=True)):
                 bs = batch_data['rep15d'].shape[0]
                 loaded_data = self._load_data(batch_data)    
@@ -656,8 +703,8 @@ class CustomTrainer(train.BaseTrainer):
 
                 remain = n%self.cfg.vae_test_len
                 
-                latent_out.append(self.eval_copy.map2latent(rec_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy()) # bs * n/8 * 240
-                latent_ori.append(self.eval_copy.map2latent(tar_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy())
+                latent_out.append(self.eval_map2latent(rec_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy()) # bs * n/8 * 240
+                latent_ori.append(self.eval_map2latent(tar_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy())
                 
                 rec_pose = rc.rotation_6d_to_matrix(rec_pose.reshape(bs*n, j, 6))
                 rec_pose = rc.matrix_to_axis_angle(rec_pose).reshape(bs*n, j*3)
@@ -704,11 +751,8 @@ class CustomTrainer(train.BaseTrainer):
         ############## Do the test data recording ##############
         latent_out = []
         latent_ori = []
-        with torch.no_grad():
-            for its, batch_data in enumerate(tqdm(self.test_loader, desc="Testing", leave=True)):
-                bs = batch_data['rep15d'].shape[0]
-                loaded_data = self._load_data(batch_data)    
-                net_out = self._g_test(loaded_data)
+        with torch.inference_mode():
+            for its, (net_out, loaded_data) in enumerate(tqdm(self._iter_test_outputs(self.test_loader), total=len(self.test_data), desc="Testing", leave=True)):
                 tar_pose = net_out['tar_pose']
                 rec_pose = net_out['rec_pose']
                 tar_exps = net_out['tar_exps']
@@ -726,8 +770,8 @@ class CustomTrainer(train.BaseTrainer):
 
                 remain = n%self.cfg.vae_test_len
                 
-                latent_out.append(self.eval_copy.map2latent(rec_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy()) # bs * n/8 * 240
-                latent_ori.append(self.eval_copy.map2latent(tar_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy())
+                latent_out.append(self.eval_map2latent(rec_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy()) # bs * n/8 * 240
+                latent_ori.append(self.eval_map2latent(tar_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy())
                 
                 rec_pose = rc.rotation_6d_to_matrix(rec_pose.reshape(bs*n, j, 6))
                 rec_pose = rc.matrix_to_axis_angle(rec_pose).reshape(bs*n, j*3)
@@ -772,7 +816,7 @@ class CustomTrainer(train.BaseTrainer):
         logger.info(f"fgd score: {fgd}")
         self.tracker.update_meter("fgd", "val", fgd)
         
-        align_avg = align/(total_length-2*len(self.test_loader)*self.align_mask)
+        align_avg = align/(total_length-2*len(self.test_data)*self.align_mask)
         logger.info(f"align score: {align_avg}")
         self.tracker.update_meter("bc", "val", align_avg)
         
@@ -780,7 +824,7 @@ class CustomTrainer(train.BaseTrainer):
         logger.info(f"l1div score: {l1div}")
         self.tracker.update_meter("l1div", "val", l1div)
                 
-        self.val_recording(epoch)
+        self.val_recording(epoch, iteration)
 
         end_time = time.time() - current_time
         logger.info(f"total inference time: {int(end_time)} s for {int(total_length/self.cfg.data.pose_fps)} s motion")
@@ -804,11 +848,9 @@ class CustomTrainer(train.BaseTrainer):
         self.model.eval()
         self.smplx.eval()
         self.eval_copy.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             
-            for its, batch_data in enumerate(tqdm(self.test_loader, desc="Testing", leave=True)):
-                loaded_data = self._load_data(batch_data)    
-                net_out = self._g_test(loaded_data)
+            for its, (net_out, loaded_data) in enumerate(tqdm(self._iter_test_outputs(self.test_loader), total=len(self.test_data), desc="Testing", leave=True)):
                 tar_pose = net_out['tar_pose']
                 rec_pose = net_out['rec_pose']
                 tar_exps = net_out['tar_exps']
@@ -826,8 +868,8 @@ class CustomTrainer(train.BaseTrainer):
 
                 remain = n%self.cfg.vae_test_len
                 
-                latent_out.append(self.eval_copy.map2latent(rec_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy()) # bs * n/8 * 240
-                latent_ori.append(self.eval_copy.map2latent(tar_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy())
+                latent_out.append(self.eval_map2latent(rec_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy()) # bs * n/8 * 240
+                latent_ori.append(self.eval_map2latent(tar_pose[:, :n-remain]).reshape(-1, self.cfg.vae_length).detach().cpu().numpy())
                 
                 rec_pose = rc.rotation_6d_to_matrix(rec_pose.reshape(bs*n, j, 6))
                 rec_pose = rc.matrix_to_axis_angle(rec_pose).reshape(bs*n, j*3)
@@ -940,7 +982,7 @@ class CustomTrainer(train.BaseTrainer):
         logger.info(f"fgd score: {fgd}")
         self.test_recording("fgd", fgd, epoch) 
         
-        align_avg = align/(total_length-2*len(self.test_loader)*self.align_mask)
+        align_avg = align/(total_length-2*len(self.test_data)*self.align_mask)
         logger.info(f"align score: {align_avg}")
         self.test_recording("bc", align_avg, epoch)
 
@@ -971,10 +1013,8 @@ class CustomTrainer(train.BaseTrainer):
         self.model.eval()
         self.smplx.eval()
         # self.eval_copy.eval()
-        with torch.no_grad():
-            for its, batch_data in enumerate(self.test_loader):
-                loaded_data = self._load_data(batch_data)    
-                net_out = self._g_test(loaded_data)
+        with torch.inference_mode():
+            for its, (net_out, loaded_data) in enumerate(self._iter_test_outputs(self.test_loader)):
                 tar_pose = net_out['tar_pose']
                 rec_pose = net_out['rec_pose']
                 tar_exps = net_out['tar_exps']
@@ -1040,7 +1080,9 @@ class CustomTrainer(train.BaseTrainer):
         # remove 'audioEncoder' from the state_dict due to legacy issues
         ckpt_state_dict = {k: v for k, v in ckpt_state_dict.items() if 'modality_encoder.audio_encoder.' not in k}
         self.model.load_state_dict(ckpt_state_dict, strict=False)
-        self.opt.load_state_dict(checkpoint['optimizer_state_dict'])
+        # last.pth is weights-only; the optimizer state comes with the periodic and best checkpoints
+        if checkpoint.get('optimizer_state_dict') is not None:
+            self.opt.load_state_dict(checkpoint['optimizer_state_dict'])
         if 'scheduler_state_dict' in checkpoint and checkpoint['scheduler_state_dict'] is not None:
             self.opt_s.load_state_dict(checkpoint['scheduler_state_dict'])
         if 'val_best' in checkpoint:
@@ -24,8 +24,38 @@ from .utils.text_features import process_word_data
 from .utils.data_sample import sample_from_clip
 from .utils import rotation_conversions as rc
 
+def build_shared_store(args):
+    """
+    Split-independent resources (SMPL-X body model, mean velocities, split table), built once
+    and passed to every CustomDataset so the train / test / test_clip instances share them.
+    """
+    return {
+        'smplx': smplx.create(
+            args.data_path_1+"smplx_models/", 
+            model_type='smplx',
+            gender='NEUTRAL_2020', 
+            use_face_contour=False,
+            num_betas=300,
+            num_expression_coeffs=100, 
+            ext='npz',
+            use_pca=False,
+        ).cuda().eval(),
+        'avg_vel': np.load(args.data_path+f"weights/mean_vel_{args.pose_rep}.npy"),
+        'split_rule': pd.read_csv(args.data_path+"train_test_split.csv"),
+    }
+
+
+def intention_cache_key(cache_dir):
+    """
+    Identifies the LMDB build that derived files (lengths, intention memmap) were made from:
+    cache_generation writes sample_db_mapping.pkl last, so a rebuild changes its mtime.
+    """
+    st = os.stat(os.path.join(cache_dir, "sample_db_mapping.pkl"))
+    return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+
 class CustomDataset(Dataset):
-    def __init__(self, args, loader_type, build_cache=True):
+    def __init__(self, args, loader_type, build_cache=True, shared_store=None, prebuilt_index=None):
         self.args = args
         self.loader_type = loader_type
         self.rank = dist.get_rank()
@@ -38,19 +68,12 @@ class CustomDataset(Dataset):
         self.ori_length = self.args.pose_length
         self.alignment = [0,0]  # for trinity
         
-        # Initialize SMPLX model
-        self.smplx = smplx.create(
-            self.args.data_path_1+"smplx_models/", 
-            model_type='smplx',
-            gender='NEUTRAL_2020', 
-            use_face_contour=False,
-            num_betas=300,
-            num_expression_coeffs=100, 
-            ext='npz',
-            use_pca=False,
-        ).cuda().eval()
-        
-        self.avg_vel = np.load(args.data_path+f"weights/mean_vel_{args.pose_rep}.npy")
+        # Initialize SMPLX model, mean velocities and split table (shared across splits when given)
+        if shared_store is None:
+            shared_store = build_shared_store(args)
+        self.smplx = shared_store['smplx']
+        self.avg_vel = shared_store['avg_vel']
+        self.split_rule = shared_store['split_rule']
         
         # Load and process split rules
         self._process_split_rules()
@@ -58,13 +81,13 @@ class CustomDataset(Dataset):
         # Initialize data directories and lengths
         self._init_data_paths()
         
-        # Build or load cache
-        self._init_cache(build_cache)
+        # Build or load cache (or take the index rank 0 already loaded, see export_index)
+        self._init_cache(build_cache, prebuilt_index)
         
     
     def _process_split_rules(self):
         """Process dataset split rules."""
-        split_rule = pd.read_csv(self.args.data_path+"train_test_split.csv")
+        split_rule = self.split_rule
         self.selected_file = split_rule.loc[
             (split_rule['type'] == self.loader_type) & 
             (split_rule['id'].str.split("_").str[0].astype(int).isin(self.args.training_speakers))
@@ -105,15 +128,36 @@ class CustomDataset(Dataset):
     
     
     
-    def _init_cache(self, build_cache):
+    def _init_cache(self, build_cache, prebuilt_index=None):
         """Initialize or build cache."""
         self.lmdb_envs = {}
         self.mapping_data = None
+        self._intention_lengths = None
         
-        if build_cache and self.rank == 0:
-            self.build_cache(self.preloaded_dir)
-        
-        self.load_db_mapping()
+        if prebuilt_index is not None:
+            self.mapping_data = prebuilt_index['mapping_data']
+            self.n_samples = len(self.mapping_data['mapping'])
+            self._intention_lengths = prebuilt_index.get('intention_lengths', None)
+        else:
+            if build_cache and self.rank == 0:
+                self.build_cache(self.preloaded_dir)
+            
+            self.load_db_mapping()
+
+        # intention embeddings served from the flat fp16 memmap written offline by export_intention_mmap.py
+        self.use_intention_mmap = getattr(self.args, "intention_mmap", False)
+        self.intention_mmap = None
+        if self.use_intention_mmap:
+            self._check_intention_mmap()
+        elif os.path.exists(os.path.join(self.preloaded_dir, "intentions_stripped")):
+            raise ValueError(f"The records in {self.preloaded_dir} carry no intention embeddings "
+                             f"(written by export_intention_mmap.py --out_dir); set intention_mmap to read them")
+
+        # width of the precomputed intention embeddings, read by custom_collate instead of probing tensors
+        if prebuilt_index is not None and 'intention_hidden_size' in prebuilt_index:
+            self.intention_hidden_size = prebuilt_index['intention_hidden_size']
+        else:
+            self.intention_hidden_size = self._read_intention_hidden_size()
     
     def build_cache(self, preloaded_dir):
         """Build the dataset cache."""
@@ -290,11 +334,12 @@ class CustomDataset(Dataset):
             for path in self.mapping_data['db_paths']:
                 updated_path = path.replace("test/", "test_clip/")
                 updated_paths.append(updated_path)
-            self.mapping_data['db_paths'] = updated_paths
-        
-            # Re-save the updated mapping_data to the same pickle file
-            with open(mapping_path, 'wb') as f:
-                pickle.dump(self.mapping_data, f)
+            # Re-save the updated mapping_data to the same pickle file, only when it actually changed,
+            # since its mtime is the cache key of the derived files (see intention_cache_key)
+            if updated_paths != self.mapping_data['db_paths']:
+                self.mapping_data['db_paths'] = updated_paths
+                with open(mapping_path, 'wb') as f:
+                    pickle.dump(self.mapping_data, f)
         
         self.n_samples = len(self.mapping_data['mapping'])
     
@@ -304,7 +349,101 @@ class CustomDataset(Dataset):
             db_path = self.mapping_data['db_paths'][db_idx]
             self.lmdb_envs[db_idx] = lmdb.open(db_path, readonly=True, lock=False)
         return self.lmdb_envs[db_idx]
-    
+
+    def export_index(self, with_lengths=False):
+        """Picklable sample index, so other ranks can be built with prebuilt_index instead of re-reading it."""
+        index = {'mapping_data': self.mapping_data, 'intention_hidden_size': self.intention_hidden_size}
+        if with_lengths:
+            index['intention_lengths'] = self.get_intention_lengths()
+        return index
+
+    def _read_intention_hidden_size(self):
+        """Width recorded in the memmap meta, else of the first pickled embedding; None without any intentions."""
+        if self.use_intention_mmap:
+            hidden_size = int(np.load(os.path.join(self.preloaded_dir, "intentions_offsets.npz"))["hidden_size"])
+            return hidden_size or None
+        envs = {}
+        try:
+            for idx in range(self.n_samples):
+                db_idx = self.mapping_data['mapping'][idx]
+                if db_idx not in envs:
+                    # short-lived envs, so nothing opened here is inherited by the DataLoader workers
+                    envs[db_idx] = lmdb.open(self.mapping_data['db_paths'][db_idx], readonly=True, lock=False)
+                with envs[db_idx].begin(write=False) as txn:
+                    intention = pickle.loads(txn.get("{:008d}".format(idx).encode("ascii")))[14]
+                if isinstance(intention, list) and len(intention) > 0:
+                    return int(intention[0]["embeddings"].shape[1])
+        finally:
+            for env in envs.values():
+                env.close()
+        return None
+
+    def get_intention_lengths(self):
+        """Total intention-embedding length per sample, computed once per cache build and kept next to the LMDB."""
+        if self._intention_lengths is not None:
+            return self._intention_lengths
+        lengths_path = os.path.join(self.preloaded_dir, "intention_lengths.npz")
+        cache_key = intention_cache_key(self.preloaded_dir)
+        if os.path.exists(lengths_path):
+            saved = np.load(lengths_path)
+            if np.array_equal(saved["cache_key"], cache_key) and len(saved["lengths"]) == self.n_samples:
+                self._intention_lengths = saved["lengths"]
+                return self._intention_lengths
+
+        if self.use_intention_mmap:
+            self._get_intention_mmap()
+            rows = self.intention_offsets[:, 1] - self.intention_offsets[:, 0]
+            # per-sample sum over its segments; reduceat misreads empty samples, so go through cumsum
+            cum = np.concatenate([[0], np.cumsum(rows)])
+            lengths = cum[self.intention_sample_ptr[1:]] - cum[self.intention_sample_ptr[:-1]]
+        else:
+            lengths = np.zeros(self.n_samples, dtype=np.int64)
+            for idx in range(self.n_samples):
+                lmdb_env = self.get_lmdb_env(self.mapping_data['mapping'][idx])
+                with lmdb_env.begin(write=False) as txn:
+                    sample = pickle.loads(txn.get("{:008d}".format(idx).encode("ascii")))
+                intention = sample[14]
+                if isinstance(intention, list):
+                    lengths[idx] = sum(item["embeddings"].shape[0] for item in intention)
+        np.savez(lengths_path, lengths=lengths, cache_key=cache_key)
+        self._intention_lengths = lengths
+        return lengths
+
+    def _check_intention_mmap(self):
+        """Fail early when the memmap is missing or belongs to an earlier build of this cache."""
+        offsets_path = os.path.join(self.preloaded_dir, "intentions_offsets.npz")
+        if not (os.path.exists(offsets_path) and os.path.exists(os.path.join(self.preloaded_dir, "intentions.bin"))):
+            raise FileNotFoundError(f"No intention memmap in {self.preloaded_dir}; run "
+                                    f"python -m dataloaders.export_intention_mmap --cache_dir {self.preloaded_dir}")
+        meta = np.load(offsets_path)
+        if "cache_key" not in meta or not np.array_equal(meta["cache_key"], intention_cache_key(self.preloaded_dir)):
+            raise ValueError(f"The intention memmap in {self.preloaded_dir} was exported from an earlier build "
+                             f"of this cache; run export_intention_mmap.py on it again")
+
+    def _get_intention_mmap(self):
+        """Open the memmap lazily so every DataLoader worker maps the file itself after fork."""
+        if self.intention_mmap is None:
+            meta = np.load(os.path.join(self.preloaded_dir, "intentions_offsets.npz"))
+            self.intention_offsets = meta["offsets"]
+            self.intention_sample_ptr = meta["sample_ptr"]
+            hidden_size = int(meta["hidden_size"])
+            bin_path = os.path.join(self.preloaded_dir, "intentions.bin")
+            if os.path.getsize(bin_path) > 0:
+                self.intention_mmap = np.memmap(bin_path, dtype=np.float16, mode='r').reshape(-1, hidden_size)
+            else:
+                self.intention_mmap = np.zeros((0, hidden_size), dtype=np.float16)
+        return self.intention_mmap
+
+    def _mmap_intention(self, idx, intention):
+        """Fill in the embeddings from the fp16 memmap, keeping text and timing from the record."""
+        mm = self._get_intention_mmap()
+        segments = self.intention_offsets[self.intention_sample_ptr[idx]:self.intention_sample_ptr[idx + 1]]
+        # copy out of the read-only map but stay fp16; custom_collate casts to the batch dtype
+        return [
+            {"embeddings": np.array(mm[start:end]), "text": item["text"], "timing": item["timing"]}
+            for item, (start, end) in zip(intention, segments)
+        ]
+
     def __len__(self):
         """Return the total number of samples in the dataset."""
         return self.n_samples
@@ -322,6 +461,8 @@ class CustomDataset(Dataset):
             
             tar_pose, in_audio, in_audio_high, in_audio_low, tar_rep15d, in_facial, in_shape, in_aligned_text, in_word, emo, sem, vid, trans, trans_v, intention, audio_name, audio_onset = sample
             
+            if self.use_intention_mmap and isinstance(intention, list) and len(intention) > 0:
+                intention = self._mmap_intention(idx, intention)
             
             # Convert data to tensors with appropriate types
             processed_data = self._convert_to_tensors(
@@ -369,7 +510,9 @@ class CustomDataset(Dataset):
         # Handle intention
         if intention is not None and isinstance(intention, list) and len(intention) > 0:
             # Stack all embeddings into a list of tensors
-            embeddings = [torch.from_numpy(item["embeddings"]).float() for item in intention]
+            embeddings = [torch.from_numpy(item["embeddings"]) for item in intention]
+            # fp16 rows from the memmap are kept as they are, pickled arrays go to float32 as before
+            embeddings = [e if e.dtype == torch.float16 else e.float() for e in embeddings]
             # Optionally, also collect text and timing if needed
             texts = [item["text"] for item in intention]
             timings = [item["timing"] for item in intention]
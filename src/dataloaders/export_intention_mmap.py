@@ -0,0 +1,114 @@
+"""
+Offline one-shot export of the precomputed intention embeddings of a CustomDataset cache into
+intentions.bin (concatenated fp16 rows) plus intentions_offsets.npz ([start, end) rows per
+segment and per-sample segment pointers), read by beat_sep_lower.CustomDataset with
+intention_mmap set.
+
+The source LMDBs are only read. With --out_dir, a separate copy of the cache is written whose
+records carry no embeddings (text and timing are kept), so __getitem__ no longer unpickles
+arrays it replaces from the memmap; point cache_path at that copy to use it.
+
+    python -m dataloaders.export_intention_mmap --cache_dir <cache_path>/train/<pose_rep>_cache
+"""
+import os
+import pickle
+import lmdb
+import numpy as np
+from tqdm import tqdm
+from argparse import ArgumentParser
+
+from dataloaders.beat_sep_lower import intention_cache_key
+
+
+def iter_samples(db_paths, sample_mapping):
+    envs = {}
+    for idx in range(len(sample_mapping)):
+        db_idx = sample_mapping[idx]
+        if db_idx not in envs:
+            envs[db_idx] = lmdb.open(db_paths[db_idx], readonly=True, lock=False)
+        key = "{:008d}".format(idx).encode("ascii")
+        with envs[db_idx].begin(write=False) as txn:
+            yield idx, key, pickle.loads(txn.get(key))
+    for env in envs.values():
+        env.close()
+
+
+def map_size(db_path):
+    env = lmdb.open(db_path, readonly=True, lock=False)
+    size = env.info()['map_size']
+    env.close()
+    return size
+
+
+def main(args):
+    # 1. Load the mapping of the source cache
+    with open(os.path.join(args.cache_dir, "sample_db_mapping.pkl"), "rb") as f:
+        mapping = pickle.load(f)
+    db_paths = mapping['db_paths']
+    sample_mapping = mapping['mapping']
+
+    # 2. Prepare the stripped copy (mirror structure), if asked for
+    out_dir = args.out_dir or args.cache_dir
+    envs_out = []
+    if args.out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+        new_db_paths = [os.path.join(out_dir, os.path.basename(os.path.normpath(p))) for p in db_paths]
+        envs_out = [lmdb.open(p, map_size=map_size(src)) for p, src in zip(new_db_paths, db_paths)]
+        write_freq = 1000
+        cache = [{} for _ in envs_out]
+
+    # 3. Export the embeddings, and write the stripped records alongside
+    bin_path = os.path.join(out_dir, "intentions.bin")
+    offsets, sample_ptr, hidden_size, row = [], [0], 0, 0
+    with open(bin_path + ".tmp", "wb") as f:
+        for idx, key, sample in tqdm(iter_samples(db_paths, sample_mapping), total=len(sample_mapping), desc="Exporting intentions"):
+            sample = list(sample)
+            intention = sample[14]
+            if isinstance(intention, list):
+                for item in intention:
+                    emb = np.ascontiguousarray(item["embeddings"], dtype=np.float16)
+                    hidden_size = emb.shape[1]
+                    f.write(emb.tobytes())
+                    offsets.append((row, row + emb.shape[0]))
+                    row += emb.shape[0]
+                sample[14] = [{"embeddings": None, "text": item["text"], "timing": item["timing"]} for item in intention]
+            sample_ptr.append(len(offsets))
+
+            if envs_out:
+                db_idx = sample_mapping[idx]
+                cache[db_idx][key] = pickle.dumps(sample)
+                if len(cache[db_idx]) >= write_freq:
+                    with envs_out[db_idx].begin(write=True) as txn:
+                        for k, v in cache[db_idx].items():
+                            txn.put(k, v)
+                    cache[db_idx] = {}
+
+    for db_idx, env in enumerate(envs_out):
+        if cache[db_idx]:
+            with env.begin(write=True) as txn:
+                for k, v in cache[db_idx].items():
+                    txn.put(k, v)
+        env.sync()
+        env.close()
+
+    # 4. Write the new mapping first: the memmap is keyed to the mapping of the cache it belongs to
+    if args.out_dir:
+        with open(os.path.join(out_dir, "sample_db_mapping.pkl"), "wb") as f:
+            pickle.dump({"db_paths": new_db_paths, "mapping": sample_mapping}, f)
+    np.savez(os.path.join(out_dir, "intentions_offsets.npz"),
+             offsets=np.asarray(offsets, dtype=np.int64).reshape(-1, 2),
+             sample_ptr=np.asarray(sample_ptr, dtype=np.int64), hidden_size=hidden_size,
+             cache_key=intention_cache_key(out_dir))
+    os.replace(bin_path + ".tmp", bin_path)
+    if args.out_dir:
+        # records without embeddings: CustomDataset refuses this cache unless intention_mmap is set
+        open(os.path.join(out_dir, "intentions_stripped"), "w").close()
+
+    print(f"Done. Saved {row} intention rows to {bin_path}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--cache_dir", type=str, required=True, help="CustomDataset cache directory holding sample_db_mapping.pkl")
+    parser.add_argument("--out_dir", type=str, default=None, help="Optional output directory for a copy of the cache without embeddings")
+    args = parser.parse_args()
+    main(args)
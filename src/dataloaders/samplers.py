@@ -0,0 +1,151 @@
+import math
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def _dist_info(num_replicas=None, rank=None):
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+    if rank is None:
+        rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    return num_replicas, rank
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler that groups samples of similar intention length, so padding
+    inside a batch stays small.
+    Each rank first takes a disjoint DistributedSampler-style subset of the shuffled
+    indices; within it, windows of bucket_mul * batch_size indices are sorted by length,
+    cut into batches, and the batches are shuffled again.
+    """
+    def __init__(self, lengths, batch_size, bucket_mul=50, shuffle=True, drop_last=True,
+                 num_replicas=None, rank=None, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_mul = bucket_mul
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas, self.rank = _dist_info(num_replicas, rank)
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = math.ceil(len(self.lengths) / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _rank_indices(self, g):
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=g).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+        # pad so every rank gets the same number of samples, as DistributedSampler does
+        indices += indices[:(self.total_size - len(indices))]
+        return indices[self.rank:self.total_size:self.num_replicas]
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = self._rank_indices(g)
+
+        window = self.bucket_mul * self.batch_size
+        batches = []
+        for start in range(0, len(indices), window):
+            chunk = sorted(indices[start:start + window], key=lambda i: self.lengths[i])
+            for b in range(0, len(chunk), self.batch_size):
+                batch = chunk[b:b + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=g).tolist()
+            batches = [batches[i] for i in order]
+        return iter(batches)
+
+    def __len__(self):
+        # batches are cut per window, so count them the same way __iter__ does
+        window = self.bucket_mul * self.batch_size
+        n = 0
+        for start in range(0, self.num_samples, window):
+            size = min(window, self.num_samples - start)
+            n += size // self.batch_size if self.drop_last else math.ceil(size / self.batch_size)
+        return n
+
+
+class PackedIntentionBatchSampler(Sampler):
+    """
+    Batch sampler that packs samples into bins of at most max_pack_len padded intention
+    tokens, i.e. len(bin) * round_up(max length in bin) <= max_pack_len, with the bin size
+    kept within [min_batch_size, max_batch_size].
+    Samples are placed first-fit-decreasing: since every bin is charged at the length of its
+    first (longest) sample, first-fit reduces to filling bins in order of decreasing length.
+    Bins are computed for all ranks from the same seed and cut to the shortest rank,
+    so every rank does the same number of steps.
+    """
+    def __init__(self, lengths, max_pack_len=2048, max_batch_size=None, min_batch_size=2, pad_multiple=8,
+                 shuffle=True, num_replicas=None, rank=None, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.max_pack_len = max_pack_len
+        self.max_batch_size = max_batch_size
+        # train_forward splits every batch into flow and consistency parts, so keep at least two
+        self.min_batch_size = min_batch_size
+        self.pad_multiple = pad_multiple
+        self.shuffle = shuffle
+        self.num_replicas, self.rank = _dist_info(num_replicas, rank)
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = math.ceil(len(self.lengths) / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+        self._bins_epoch, self._bins = None, None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _padded_len(self, length):
+        return max(math.ceil(length / self.pad_multiple) * self.pad_multiple, self.pad_multiple)
+
+    def _pack(self, indices):
+        # stable sort on a shuffled list, so samples of equal length land in different bins each epoch
+        indices = sorted(indices, key=lambda i: -self.lengths[i])
+        bins, start = [], 0
+        while start < len(indices):
+            capacity = max(self.max_pack_len // self._padded_len(self.lengths[indices[start]]), self.min_batch_size)
+            if self.max_batch_size is not None:
+                capacity = min(capacity, self.max_batch_size)
+            bins.append(indices[start:start + capacity])
+            start += capacity
+        return bins
+
+    def _all_rank_bins(self):
+        # packing is the expensive part, and __len__ and __iter__ need the same bins; pack once per epoch
+        if self._bins_epoch != self.epoch:
+            self._bins_epoch, self._bins = self.epoch, self._pack_all_ranks()
+        return self._bins
+
+    def _pack_all_ranks(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=g).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+        indices += indices[:(self.total_size - len(indices))]
+        return [self._pack(indices[r:self.total_size:self.num_replicas]) for r in range(self.num_replicas)]
+
+    def __iter__(self):
+        all_bins = self._all_rank_bins()
+        num_bins = min(len(bins) for bins in all_bins)
+        bins = all_bins[self.rank]
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch + self.rank + 1)
+            order = torch.randperm(len(bins), generator=g).tolist()
+            bins = [bins[i] for i in order]
+        return iter(bins[:num_bins])
+
+    def __len__(self):
+        return min(len(bins) for bins in self._all_rank_bins())
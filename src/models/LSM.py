@@ -1,9 +1,9 @@
 import time
 import inspect
 import logging
-from typing import Optional
+import functools
+from typing import NamedTuple, Optional, Union
 
-import scipy.stats as stats
 import tqdm
 import numpy as np
 from omegaconf import DictConfig
@@ -19,37 +19,24 @@ from models.utils.utils import count_parameters, extract_into_tensor, sum_flat
 
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=None)
+def _expm1(a):
+    # exp(a) - 1 for the (fixed) exponential-schedule rate; cached since a never changes
+    return math.expm1(a)
+
 def exponential_pdf(x, a):
-    C = a / (np.exp(a) - 1)
+    C = a / _expm1(a)
     return C * np.exp(a * x)
 
-# Define a custom probability density function
-class ExponentialPDF(stats.rv_continuous):
-    def _pdf(self, x, a):
-        return exponential_pdf(x, a)
-
-def sample_t(exponential_pdf, num_samples, a=2):
-    t = exponential_pdf.rvs(size=num_samples, a=a)
-    t = torch.from_numpy(t).float()
-    t = torch.cat([t, 1 - t], dim=0)
-    t = t[torch.randperm(t.shape[0])]
-    t = t[:num_samples]
-
-    t_min = 1e-5
-    t_max = 1-1e-5
-
-    # Scale t to [t_min, t_max]
-    t = t * (t_max - t_min) + t_min
-    return t
-
 def sample_beta_distribution(num_samples, alpha=2, beta=0.8, t_min=1e-5, t_max=1-1e-5):
     """
     Samples from a Beta distribution with the specified parameters.
     
     Args:
         num_samples (int): Number of samples to generate.
-        alpha (float): Alpha parameter of the Beta distribution (shape1).
-        beta (float): Beta parameter of the Beta distribution (shape2).
+        alpha (float or torch.Tensor): Alpha parameter of the Beta distribution (shape1).
+        beta (float or torch.Tensor): Beta parameter of the Beta distribution (shape2).
+            Passing tensors samples on their device.
         t_min (float): Minimum value for scaling the samples (default is near 0).
         t_max (float): Maximum value for scaling the samples (default is near 1).
         
@@ -67,22 +54,20 @@ def sample_beta_distribution(num_samples, alpha=2, beta=0.8, t_min=1e-5, t_max=1
     
     return scaled_samples
 
-def sample_t_fast(num_samples, a=2, t_min=1e-5, t_max=1-1e-5):
+def sample_t_fast(num_samples, a=2, t_min=1e-5, t_max=1-1e-5, device='cpu', generator=None):
     # Direct inverse sampling for exponential distribution
-    C = a / (np.exp(a) - 1)
-    
     # Generate uniform samples
-    u = torch.rand(num_samples * 2)
+    u = torch.rand(num_samples * 2, device=device, generator=generator)
     
     # Inverse transform sampling formula for the exponential PDF
-    # F^(-1)(u) = (1/a) * ln(1 + u*(exp(a) - 1))
-    t = (1/a) * torch.log(1 + u * (np.exp(a) - 1))
+    # F^(-1)(u) = (1/a) * ln(1 + u*(exp(a) - 1)), written with log1p/expm1 for precision
+    t = torch.log1p(u * _expm1(a)) / a
     
     # Combine t and 1-t
     t = torch.cat([t, 1 - t])
     
     # Random permutation and slice
-    t = t[torch.randperm(t.shape[0])][:num_samples]
+    t = t[torch.randperm(t.shape[0], device=device, generator=generator)][:num_samples]
     
     # Scale to [t_min, t_max]
     t = t * (t_max - t_min) + t_min
@@ -108,8 +93,48 @@ def sample_cosmap(num_samples, t_min=1e-5, t_max=1-1e-5, device='cpu'):
     
     return t
 
+def pseudo_huber_per_sample(a, b):
+    # per-sample pseudo-Huber over (T, C); sum -> sqrt -> sub -> div fuse into one kernel when compiled
+    data_dim = a.shape[1] * a.shape[2]
+    huber_c = 0.00054 * data_dim
+    loss = torch.sum((a - b) ** 2, dim=(1, 2))
+    loss = torch.sqrt(loss + huber_c**2) - huber_c
+    return loss / data_dim
+
+def mse_per_sample(a, b):
+    # per-sample MSE over (T, C); returns a [B] tensor
+    return (a - b).square().mean(dim=(1, 2))
+
+class ConditionBatch(NamedTuple):
+    """Conditioning inputs of GestureLSM, unpacked once instead of per-key dict lookups.
+
+    A NamedTuple rather than a dataclass so DataParallel's scatter still splits it along the batch.
+    """
+    audio_tensor: torch.Tensor
+    audio_low: torch.Tensor
+    audio_high: torch.Tensor
+    id: torch.Tensor
+    seed: torch.Tensor
+    style_feature: Optional[torch.Tensor] = None
+    intention_embeddings: Optional[torch.Tensor] = None
+    intention_mask: Optional[torch.Tensor] = None
+    audio_onset: Optional[torch.Tensor] = None
+    word: Optional[torch.Tensor] = None
+
+    @classmethod
+    def from_dict(cls, y: Dict) -> "ConditionBatch":
+        """Build from the legacy condition_dict['y'] layout."""
+        return cls(**{k: y.get(k) for k in cls._fields})
+
+    def to(self, device, non_blocking=False) -> "ConditionBatch":
+        return self._replace(**{
+            k: v.to(device, non_blocking=non_blocking)
+            for k, v in self._asdict().items() if torch.is_tensor(v)
+        })
+
 def reshape_coefs(t):
-    return t.reshape((t.shape[0], 1, 1, 1))
+    # latents are (B, C, T)
+    return t.view(t.shape[0], 1, 1)
 
 class GestureLSM(torch.nn.Module):
     def __init__(self, cfg) -> None:
@@ -124,7 +149,6 @@ class GestureLSM(torch.nn.Module):
         self.do_classifier_free_guidance = cfg.model.do_classifier_free_guidance
         self.guidance_scale = cfg.model.guidance_scale
         self.num_inference_steps = cfg.model.n_steps
-        self.exponential_distribution = ExponentialPDF(a=0, b=1, name='ExponentialPDF')
         self.input_dim = self.denoiser.input_dim
 
         # Loss functions
@@ -134,42 +158,100 @@ class GestureLSM(torch.nn.Module):
         
         self.seq_len = self.cfg.model.denoiser.params.seq_len
         self.raw_audio = self.cfg.model.raw_audio
+
+        # Constant sampling schedules, kept as non-persistent buffers so they follow the module's device
+        epsilon = 1e-8
+        self.register_buffer('deltas', 1.0 / torch.tensor([2.0 ** i for i in range(1, 8)]), persistent=False)
+        self.register_buffer('inference_timesteps', torch.linspace(epsilon, 1 - epsilon, self.num_inference_steps + 1), persistent=False)
+        self.register_buffer('loss_timesteps', torch.linspace(epsilon, 1 - epsilon, 50 + 1), persistent=False)
+        # Beta(2, 1.2) concentrations for reflow t sampling
+        self.register_buffer('beta_alpha', torch.tensor(2.0), persistent=False)
+        self.register_buffer('beta_beta', torch.tensor(1.2), persistent=False)
+
+        # Optionally capture the inference step with torch.compile (CUDA graphs under reduce-overhead).
+        # The unbound function is compiled so DataParallel replicas still step with their own weights.
+        self.compile_step = cfg.model.get('compile', False)
+        if self.compile_step:
+            self._compiled_denoiser_step = torch.compile(type(self)._denoiser_step, mode='reduce-overhead', fullgraph=False)
+        # Opt-in fused losses; compiling at import time made every run pay for inductor even when eager.
+        if cfg.model.get('compile_loss', False):
+            self.mse_per_sample = torch.compile(mse_per_sample, dynamic=True)
+            self.pseudo_huber_per_sample = torch.compile(pseudo_huber_per_sample, dynamic=True)
+        else:
+            self.mse_per_sample = mse_per_sample
+            self.pseudo_huber_per_sample = pseudo_huber_per_sample
+
+    def _denoiser_step(self, x_t, current_t, current_delta, seed, at_feat, intent_feat, instance_ids, style_features, dt, inplace=False):
+        """One Euler step of the sampler: x_t + dt * v(x_t, t).
+
+        With inplace=True, dt is a python float and x_t is updated in place; the compiled
+        path passes dt as a tensor and returns a new x_t so graph inputs are never mutated.
+        """
+        speed = self.denoiser.forward_with_cfg(
+            x=x_t,
+            timesteps=current_t,
+            seed=seed,
+            at_feat=at_feat,
+            intent_feat=intent_feat,
+            cond_time=current_delta,
+            instance_ids=instance_ids,
+            style_features=style_features,
+            guidance_scale=self.guidance_scale
+        )
+        if inplace:
+            return x_t.add_(speed, alpha=dt)
+        return torch.addcmul(x_t, speed, dt.view(1, 1, 1))
+
     def summarize_parameters(self) -> None:
         logger.info(f'Denoiser: {count_parameters(self.denoiser)}M')
         logger.info(f'Encoder: {count_parameters(self.modality_encoder)}M')
     
-    def forward(self, condition_dict: Dict[str, Dict]) -> Dict[str, torch.Tensor]:
-        """Forward pass for inference.
+    def forward(self, condition: Union[ConditionBatch, Dict[str, Dict]], *args, mode: str = 'sample', **kwargs) -> Dict[str, torch.Tensor]:
+        """Forward pass for inference, or a training step when mode is 'train' or 'reflow'.
+        
+        Training goes through forward rather than calling train_forward / train_reflow on
+        model.module, so the DDP wrapper's forward runs and its static-graph and bucket
+        settings apply.
         
         Args:
-            condition_dict: Dictionary containing input conditions including audio, word tokens,
-                          and other features
+            condition: ConditionBatch (or legacy {'y': {...}} dictionary) containing input conditions
+                       including audio, word tokens, and other features; for mode='reflow', the
+                       first argument of train_reflow
+            mode: 'sample' (default), 'train' (train_forward) or 'reflow' (train_reflow); extra
+                  arguments are passed on to those methods
         
         Returns:
-            Dictionary containing generated latents
+            Dictionary containing generated latents, or the loss dictionary in training modes
         """
+        if mode == 'train':
+            return self.train_forward(condition, *args, **kwargs)
+        if mode == 'reflow':
+            return self.train_reflow(condition, *args, **kwargs)
+        if mode != 'sample':
+            raise ValueError(f"Unknown forward mode {mode!r}")
+        
         # Extract input features
-        in_audio = condition_dict['y']['audio_tensor']
-        cached_audio_low = condition_dict['y']['audio_low']
-        cached_audio_high = condition_dict['y']['audio_high']
-        instance_ids = condition_dict['y']['id']
-        seed_vectors = condition_dict['y']['seed']
-        style_features = condition_dict['y']['style_feature']
-        intention_embeddings = condition_dict['y']['intention_embeddings']
-        intention_mask = condition_dict['y']['intention_mask']
-        audio_onset = None
-        if 'audio_onset' in condition_dict['y']:
-            audio_onset = condition_dict['y']['audio_onset']
-        if 'word' in condition_dict['y']:
-            word = condition_dict['y']['word']
+        if isinstance(condition, dict):
+            condition = ConditionBatch.from_dict(condition['y'])
+        condition = condition.to(self.deltas.device, non_blocking=True)
+        if self.compile_step:
+            # new CUDA graph generation per call: the previous call's outputs are no longer live
+            torch.compiler.cudagraph_mark_step_begin()
+        in_audio = condition.audio_tensor
+        cached_audio_low = condition.audio_low
+        cached_audio_high = condition.audio_high
+        instance_ids = condition.id
+        seed_vectors = condition.seed
+        style_features = condition.style_feature
+        intention_embeddings = condition.intention_embeddings
+        intention_mask = condition.intention_mask
+        audio_onset = condition.audio_onset
+        word = condition.word
         return_dict = {}
         return_dict['seed'] = seed_vectors
         
         # Encode input modalities
-        if audio_onset is not None and self.raw_audio:
-            audio_features = self.modality_encoder(in_audio, cached_audio_low, cached_audio_high, intention_embeddings, intention_mask, audio_onset, word)
-        else:
-            audio_features = self.modality_encoder(in_audio, cached_audio_low, cached_audio_high, intention_embeddings, intention_mask, audio_onset, word)
+        audio_features = self.modality_encoder(in_audio, cached_audio_low, cached_audio_high, intention_embeddings, intention_mask, audio_onset, word)
         at_feat = audio_features['audio_low']
         intent_feat = audio_features['audio_high']
         return_dict['at_feat'] = at_feat
@@ -177,7 +259,7 @@ class GestureLSM(torch.nn.Module):
 
         # Initialize generation
         batch_size = at_feat.shape[0]
-        latent_shape = (batch_size, self.input_dim, 1, self.seq_len)
+        latent_shape = (batch_size, self.input_dim, self.seq_len)
 
         
         
@@ -186,29 +268,28 @@ class GestureLSM(torch.nn.Module):
 
         return_dict['init_noise'] = x_t
         
-        epsilon = 1e-8
         delta_t = torch.tensor(1 / self.num_inference_steps).to(at_feat.device)
-        timesteps = torch.linspace(epsilon, 1 - epsilon, self.num_inference_steps + 1).to(at_feat.device)
+        timesteps = self.inference_timesteps
+        dts = torch.diff(timesteps)
+        current_delta = delta_t.view(1)
+        if not self.compile_step:
+            # One host sync for all step sizes, then update a private copy of x_t in place
+            dts = dts.tolist()
+            x_t = x_t.clone()
         
         # Generation loop
-        for step in range(1, len(timesteps)):
-            current_t = timesteps[step - 1].unsqueeze(0)
-            current_delta = delta_t.unsqueeze(0)
-            
-            with torch.no_grad():
-                speed = self.denoiser.forward_with_cfg(
-                    x=x_t,
-                    timesteps=current_t,
-                    seed=seed_vectors,
-                    at_feat=at_feat,
-                    intent_feat=intent_feat if intent_feat is not None else None,
-                    cond_time=current_delta,
-                    instance_ids=instance_ids,
-                    style_features=style_features,
-                    guidance_scale=self.guidance_scale
-                )
-               
-            x_t = x_t + (timesteps[step] - timesteps[step - 1]) * speed
+        with torch.no_grad():
+            for step in range(1, len(timesteps)):
+                current_t = timesteps[step - 1:step]
+                step_args = (x_t, current_t, current_delta, seed_vectors, at_feat, intent_feat,
+                             instance_ids, style_features)
+                if self.compile_step:
+                    x_t = self._compiled_denoiser_step(self, *step_args, dts[step - 1:step])
+                else:
+                    x_t = self._denoiser_step(*step_args, dts[step - 1], inplace=True)
+        if self.compile_step:
+            # the graph owns x_t's memory and the next replay (e.g. the next _g_test window) overwrites it
+            x_t = x_t.clone()
         return_dict['latents'] = x_t
         return return_dict
     
@@ -238,64 +319,58 @@ class GestureLSM(torch.nn.Module):
         # Initialize noise
         x0_noise = torch.randn_like(latents)
 
-        # Sample timesteps and deltas
-        deltas = 1 / torch.tensor([2 ** i for i in range(1, 8)]).to(latents.device)
-        delta_probs = torch.ones((deltas.shape[0],)).to(latents.device) / deltas.shape[0]
-
         batch_size = latents.shape[0]
         flow_batch_size = int(batch_size * 3/4)
 
-        # Sample random coefficients
-        epsilon = 1e-8
+        timesteps = self.loss_timesteps
+        n_probe = len(timesteps) - 1
 
-        timesteps = torch.linspace(epsilon, 1 - epsilon, 50 + 1).to(audio_features.device)
-
-        losses = {}
-        for step in range(1, len(timesteps)):
-            t = timesteps[step - 1].unsqueeze(0).repeat((batch_size,))
+        # The probes are independent (same latents / noise, d = 0 on the flow slice), so stack
+        # several timesteps along the batch axis; the chunk size bounds activation memory
+        probe_chunk = self.cfg.model.get('loss_probe_chunk', 10)
+        latents_f = latents[:flow_batch_size]
+        noise_f = x0_noise[:flow_batch_size]
+        flow_target = latents_f - noise_f
 
-            # t = sample_t_fast(batch_size).to(latents.device)
-            d = deltas[delta_probs.multinomial(batch_size, replacement=True)]
-            d[:flow_batch_size] = 0
+        loss_mat = torch.empty(n_probe, flow_batch_size, device=latents.device)
+        for start in range(0, n_probe, probe_chunk):
+            t_chunk = timesteps[start:min(start + probe_chunk, n_probe)]
+            n = t_chunk.shape[0]
+            t = t_chunk.repeat_interleave(flow_batch_size)
 
             # Prepare inputs
-            t_coef = reshape_coefs(t)
-            x_t = t_coef * latents + (1 - t_coef) * x0_noise
-            t = t_coef.flatten()
+            x_t = torch.lerp(torch.cat([noise_f] * n), torch.cat([latents_f] * n), reshape_coefs(t))
             
             # Flow matching loss
             flow_pred = self.denoiser(
-                x=x_t[:flow_batch_size],
-                timesteps=t[:flow_batch_size],
-                seed=seed_vectors[:flow_batch_size],
-                at_feat=audio_features[:flow_batch_size],
-                cond_time=d[:flow_batch_size],
-                instance_ids=instance_ids[:flow_batch_size],
-                style_features=style_features[:flow_batch_size],
+                x=x_t,
+                timesteps=t,
+                seed=torch.cat([seed_vectors[:flow_batch_size]] * n),
+                at_feat=torch.cat([audio_features[:flow_batch_size]] * n),
+                cond_time=torch.zeros_like(t),
+                instance_ids=torch.cat([instance_ids[:flow_batch_size]] * n),
+                style_features=torch.cat([style_features[:flow_batch_size]] * n) if style_features is not None else None,
             )
             
-            flow_target = latents[:flow_batch_size] - x0_noise[:flow_batch_size]
+            flow_loss = self.mse_per_sample(torch.cat([flow_target] * n), flow_pred)
             
-            flow_loss = F.mse_loss(flow_target, flow_pred, reduction='none').mean(dim=(1, 2, 3))
-            
-            losses[t[0].item()] = flow_loss.tolist()
-
+            loss_mat[start:start + n] = flow_loss.view(n, flow_batch_size)
+        t_keys = timesteps[:-1]
 
         #plot this loss
-        # save this loss into a csv file
-        with open(save_path + f'loss_{iter}.csv', 'w') as f:
-            for key, loss_vals in losses.items():
-                loss_vals_str = "\t".join(map(str, loss_vals))
-                f.write(f"{key}\t{loss_vals_str}\n")
+        # save this loss into a csv file, one row per timestep: t followed by the per-sample losses
+        arr = torch.cat([t_keys.unsqueeze(1), loss_mat], dim=1).detach().cpu().numpy()
+        np.savetxt(save_path + f'loss_{iter}.csv', arr, delimiter='\t')
 
+        losses = {row[0].item(): row[1:].tolist() for row in arr}
         return losses
     
-    def train_forward(self, condition_dict: Dict[str, Dict], 
+    def train_forward(self, condition: Union[ConditionBatch, Dict[str, Dict]], 
                               latents: torch.Tensor, train_consistency=False) -> Dict[str, torch.Tensor]:
         """Compute training losses for both flow matching and consistency.
         
         Args:
-            condition_dict: Dictionary containing training conditions
+            condition: ConditionBatch (or legacy {'y': {...}} dictionary) containing training conditions
             latents: Target latent vectors
             
         Returns:
@@ -303,28 +378,23 @@ class GestureLSM(torch.nn.Module):
         """
 
         # Extract input features
-        in_audio = condition_dict['y']['audio_tensor']
-        cached_audio_low = condition_dict['y']['audio_low']
-        cached_audio_high = condition_dict['y']['audio_high']
-        audio_onset = None
-        if 'audio_onset' in condition_dict['y']:
-            audio_onset = condition_dict['y']['audio_onset']
-        if 'word' in condition_dict['y']:
-            word = condition_dict['y']['word']
-        else:
-            word = None
+        if isinstance(condition, dict):
+            condition = ConditionBatch.from_dict(condition['y'])
+        condition = condition.to(latents.device, non_blocking=True)
+        in_audio = condition.audio_tensor
+        cached_audio_low = condition.audio_low
+        cached_audio_high = condition.audio_high
+        audio_onset = condition.audio_onset
+        word = condition.word
         
-        instance_ids = condition_dict['y']['id']
-        seed_vectors = condition_dict['y']['seed']
-        style_features = condition_dict['y']['style_feature']
-        intention_embeddings = condition_dict['y']['intention_embeddings']
-        intention_mask = condition_dict['y']['intention_mask']
+        instance_ids = condition.id
+        seed_vectors = condition.seed
+        style_features = condition.style_feature
+        intention_embeddings = condition.intention_embeddings
+        intention_mask = condition.intention_mask
         
         # Encode input modalities
-        if audio_onset is not None and self.raw_audio:
-            audio_features = self.modality_encoder(in_audio, cached_audio_low, cached_audio_high, intention_embeddings, intention_mask, audio_onset, word)
-        else:
-            audio_features = self.modality_encoder(in_audio, cached_audio_low, cached_audio_high, intention_embeddings, intention_mask, audio_onset, word)
+        audio_features = self.modality_encoder(in_audio, cached_audio_low, cached_audio_high, intention_embeddings, intention_mask, audio_onset, word)
         at_feat = audio_features['audio_low']
         intent_feat = audio_features['audio_high']
 
@@ -332,8 +402,7 @@ class GestureLSM(torch.nn.Module):
         x0_noise = torch.randn_like(latents)
 
         # Sample timesteps and deltas
-        deltas = 1 / torch.tensor([2 ** i for i in range(1, 8)]).to(latents.device)
-        delta_probs = torch.ones((deltas.shape[0],)).to(latents.device) / deltas.shape[0]
+        deltas = self.deltas
 
         batch_size = latents.shape[0]
         flow_batch_size = int(batch_size * 3/4)
@@ -342,13 +411,12 @@ class GestureLSM(torch.nn.Module):
         # t = sample_beta_distribution(batch_size, alpha=2, beta=1.2).to(latents.device)
         # t = sample_beta_distribution(batch_size, alpha=2, beta=0.8).to(latents.device)
         t = torch.sigmoid(torch.randn(batch_size, device=latents.device))
-        d = deltas[delta_probs.multinomial(batch_size, replacement=True)]
+        d = deltas[torch.randint(0, deltas.numel(), (batch_size,), device=latents.device)]
         d[:flow_batch_size] = 0
 
         # Prepare inputs
         t_coef = reshape_coefs(t)
-        x_t = t_coef * latents + (1 - t_coef) * x0_noise
-        t = t_coef.flatten()
+        x_t = torch.lerp(x0_noise, latents, t_coef)
         
         # Flow matching loss
         flow_pred = self.denoiser(
@@ -365,53 +433,65 @@ class GestureLSM(torch.nn.Module):
         flow_target = latents[:flow_batch_size] - x0_noise[:flow_batch_size]
         
         losses = {}
-        flow_loss = (F.mse_loss(flow_target, flow_pred) / t).mean()
+        # Per-sample MSE weighted by 1 / t of that sample
+        flow_loss = (self.mse_per_sample(flow_target, flow_pred) / t[:flow_batch_size]).mean()
         losses['flow_loss'] = flow_loss
 
         # Consistency loss computation
         # Jan 11, perform cfg at the same time, 50% true and 50% false
-        force_cfg = np.random.choice([True, False], size=batch_size-flow_batch_size, p=[0.5, 0.5])
+        force_cfg = torch.bernoulli(torch.full((batch_size - flow_batch_size,), 0.5, device=latents.device)).bool()
+
+        # Slice the consistency part of the batch once and reuse it in the three denoiser calls below
+        cons_slc = slice(flow_batch_size, None)
+        x_cons = x_t[cons_slc]
+        t_cons = t[cons_slc]
+        d_cons = d[cons_slc]
+        seed_cons = seed_vectors[cons_slc]
+        at_cons = at_feat[cons_slc]
+        intent_cons = intent_feat[cons_slc] if intent_feat is not None else None
+        ids_cons = instance_ids[cons_slc]
+        style_cons = style_features[cons_slc] if style_features is not None else None
+
+        # speed_t and speed_td are targets only; keep them out of autograd so they save no activations
         with torch.no_grad():
             speed_t = self.denoiser(
-                x=x_t[flow_batch_size:],
-                timesteps=t[flow_batch_size:],
-                seed=seed_vectors[flow_batch_size:],
-                at_feat=at_feat[flow_batch_size:],
-                intent_feat=intent_feat[flow_batch_size:] if intent_feat is not None else None,
-                cond_time=d[flow_batch_size:],
-                instance_ids=instance_ids[flow_batch_size:],
-                style_features=style_features[flow_batch_size:] if style_features is not None else None,
+                x=x_cons,
+                timesteps=t_cons,
+                seed=seed_cons,
+                at_feat=at_cons,
+                intent_feat=intent_cons,
+                cond_time=d_cons,
+                instance_ids=ids_cons,
+                style_features=style_cons,
                 force_cfg=force_cfg,
             )
-            
-            d_coef = reshape_coefs(d)
-            x_td = x_t[flow_batch_size:] + d_coef[flow_batch_size:] * speed_t
-            d = d_coef.flatten()
+
+            x_td = x_cons + reshape_coefs(d_cons) * speed_t
 
             speed_td = self.denoiser(
                 x=x_td,
-                timesteps=t[flow_batch_size:] + d[flow_batch_size:],
-                seed=seed_vectors[flow_batch_size:],
-                at_feat=at_feat[flow_batch_size:],
-                intent_feat=intent_feat[flow_batch_size:] if intent_feat is not None else None ,
-                cond_time=d[flow_batch_size:],
-                instance_ids=instance_ids[flow_batch_size:],
-                style_features=style_features[flow_batch_size:] if style_features is not None else None,
+                timesteps=t_cons + d_cons,
+                seed=seed_cons,
+                at_feat=at_cons,
+                intent_feat=intent_cons,
+                cond_time=d_cons,
+                instance_ids=ids_cons,
+                style_features=style_cons,
                 force_cfg=force_cfg,
             )
             
             speed_target = (speed_t + speed_td) / 2
         
         speed_pred = self.denoiser(
-            x=x_t[flow_batch_size:],
-            timesteps=t[flow_batch_size:],
-            seed=seed_vectors[flow_batch_size:],
-            at_feat=at_feat[flow_batch_size:],
-            intent_feat=intent_feat[flow_batch_size:] if intent_feat is not None else None,
-            cond_time=2 * d[flow_batch_size:],
+            x=x_cons,
+            timesteps=t_cons,
+            seed=seed_cons,
+            at_feat=at_cons,
+            intent_feat=intent_cons,
+            cond_time=2 * d_cons,
+            instance_ids=ids_cons,
+            style_features=style_cons,
             force_cfg=force_cfg,
-            instance_ids=instance_ids[flow_batch_size:],
-            style_features=style_features[flow_batch_size:] if style_features is not None else None,
         )
         
         consistency_loss = F.mse_loss(speed_pred, speed_target, reduction="mean")
@@ -433,22 +513,20 @@ class GestureLSM(torch.nn.Module):
         """
 
         # Sample timesteps and deltas
-        deltas = 1 / torch.tensor([2 ** i for i in range(1, 8)]).to(latents.device)
-        delta_probs = torch.ones((deltas.shape[0],)).to(latents.device) / deltas.shape[0]
+        deltas = self.deltas
 
         batch_size = latents.shape[0]
         flow_batch_size = int(batch_size * 3/4)
 
         # Sample random coefficients
-        t = sample_beta_distribution(batch_size, alpha=2, beta=1.2).to(latents.device)
+        t = sample_beta_distribution(batch_size, alpha=self.beta_alpha, beta=self.beta_beta)
         # t = sample_beta_distribution(batch_size, alpha=2, beta=0.8).to(latents.device)
-        d = deltas[delta_probs.multinomial(batch_size, replacement=True)]
+        d = deltas[torch.randint(0, deltas.numel(), (batch_size,), device=latents.device)]
         d[:flow_batch_size] = 0
 
         # Prepare inputs
         t_coef = reshape_coefs(t)
-        x_t = t_coef * latents + (1 - t_coef) * x0_noise
-        t = t_coef.flatten()
+        x_t = torch.lerp(x0_noise, latents, t_coef)
         
         # Flow matching loss
         flow_pred = self.denoiser(
@@ -463,12 +541,13 @@ class GestureLSM(torch.nn.Module):
         flow_target = latents[:flow_batch_size] - x0_noise[:flow_batch_size]
         
         losses = {}
-        flow_loss = (F.mse_loss(flow_target, flow_pred) / t).mean()
+        # Per-sample MSE weighted by 1 / t of that sample
+        flow_loss = (self.mse_per_sample(flow_target, flow_pred) / t[:flow_batch_size]).mean()
         losses['flow_loss'] = flow_loss
 
         # Consistency loss computation
         # Jan 11, perform cfg at the same time, 50% true and 50% false
-        force_cfg = np.random.choice([True, False], size=batch_size-flow_batch_size, p=[0.8, 0.2])
+        force_cfg = torch.bernoulli(torch.full((batch_size - flow_batch_size,), 0.8, device=latents.device)).bool()
         with torch.no_grad():
             speed_t = self.denoiser(
                 x=x_t[flow_batch_size:],
@@ -482,7 +561,6 @@ class GestureLSM(torch.nn.Module):
             
             d_coef = reshape_coefs(d)
             x_td = x_t[flow_batch_size:] + d_coef[flow_batch_size:] * speed_t
-            d = d_coef.flatten()
 
             speed_td = self.denoiser(
                 x=x_td,
@@ -513,13 +591,9 @@ class GestureLSM(torch.nn.Module):
 
     
     def huber_loss(self, a, b, reduction='mean'):
-        data_dim = a.shape[1] * a.shape[2] * a.shape[3]
-        huber_c = 0.00054 * data_dim
-        loss = torch.sum((a - b) ** 2, dim=(1, 2, 3))
-        loss = torch.sqrt(loss + huber_c**2) - huber_c
-        loss = loss / data_dim
+        loss = self.pseudo_huber_per_sample(a, b)
         if reduction == 'mean':
             loss = loss.mean()
         elif reduction == 'sum':
             loss = loss.sum()
-        return loss
\ No newline at end of file
+        return loss
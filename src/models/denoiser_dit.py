@@ -100,7 +100,7 @@ class GestureDenoiser(nn.Module):
         """
         Forward pass with classifier-free guidance.
         Args:
-            x: [batch_size, njoints, nfeats, max_frames]
+            x: [batch_size, nfeats, max_frames]
             timesteps: [batch_size]
             seed: the previous gesture segment
             at_feat: the audio feature
@@ -135,15 +135,17 @@ class GestureDenoiser(nn.Module):
 
     def forward(self, x, timesteps, seed, at_feat, intent_feat=None, cond_time=None, cond_drop_prob: float = 0.1, null_cond=False, do_classifier_free_guidance=False, force_cfg=None, instance_ids=None, style_features=None):
         """
-        x: [batch_size, njoints, nfeats, max_frames], denoted x_t in the paper
+        x: [batch_size, nfeats, max_frames], denoted x_t in the paper; a legacy
+           [batch_size, nfeats, 1, max_frames] input is squeezed and returned in the same layout
         timesteps: [batch_size] (int)
         seed: [batch_size, njoints, nfeats]
         intent_feat: [batch_size, njoints, nfeats]
         do_classifier_free_guidance: whether to perform classifier-free guidance (doubles batch)
         """
-        _,_,_,noise_length = x.shape
+        noise_length = x.shape[-1]
         
-        if x.shape[2] == 1:
+        legacy_4d = x.dim() == 4
+        if legacy_4d:
             x = x.squeeze(2)
             
         # Double the batch for classifier free guidance
@@ -198,7 +200,7 @@ class GestureDenoiser(nn.Module):
                 if null_cond:
                     at_feat = self.null_cond_embed.to(at_feat.dtype).unsqueeze(0).expand(bs, -1, -1)
             else:
-                force_cfg = torch.tensor(force_cfg, device=at_feat.device)
+                force_cfg = torch.as_tensor(force_cfg, device=at_feat.device)
                 force_cfg_embed = rearrange(force_cfg, "b -> b 1 1")
 
                 null_cond_embed = self.null_cond_embed.to(at_feat.dtype)
@@ -245,7 +247,9 @@ class GestureDenoiser(nn.Module):
         output = xseq                
 
         output = self.output_process(output)
-        output = output.permute(0, 2, 1).reshape(bs, -1, 1, nframes)
+        output = output.permute(0, 2, 1)
+        if legacy_4d:
+            output = output.unsqueeze(2)
         return output[...,:noise_length]
 
 
@@ -24,66 +24,168 @@ import wandb
 import matplotlib.pyplot as plt
 from utils import logger_tools, other_tools, metric
 import shutil
+import glob
 import argparse
 from omegaconf import OmegaConf
 from datetime import datetime
 import importlib
+import copy
+import functools
+import threading
+import subprocess
+from safetensors.torch import save_file, load_file
 from torch.utils.data import DataLoader
-from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data._utils.collate import default_collate
 from dataloaders.build_vocab import Vocab
+from dataloaders.samplers import LengthBucketSampler, PackedIntentionBatchSampler
 
 
-def custom_collate(batch):
-    batch_out = {}
-    for key in batch[0]:
+def collate_intentions_padded(batch, key='intention_embeddings', pad_multiple=8, dtype=None, hidden_size=None):
+    """
+    Dense layout: [batch, max_len, hidden] zero-padded tensor plus a bool mask (True = valid).
+    Lengths are computed first so the output is allocated once and each row copied in place.
+    max_len is rounded up to pad_multiple so the downstream fp16 GEMMs stay Tensor Core aligned.
+    The output keeps the source dtype (fp16 from the intention memmap) unless dtype is given, e.g.
+    bf16 to halve a float32 copy; the trainer upcasts on device.
+    hidden_size normally comes from the dataset; only when it is None are the tensors probed for it
+    """
+    # sample[key] is a list of [seq_len, hidden] tensors, empty if the sample has no intention
+    per_sample = [torch.cat(sample[key], dim=0) if len(sample[key]) > 0 else None for sample in batch]
+    lengths = [0 if t is None else t.shape[0] for t in per_sample]
+    if hidden_size is None:
+        hidden_size = next((t.shape[1] for t in per_sample if t is not None), 768)  # 768 as fallback
+    max_len = max(max(lengths, default=0), 1)
+    max_len = ((max_len + pad_multiple - 1) // pad_multiple) * pad_multiple
+
+    if dtype is None:
+        dtype = next((t.dtype for t in per_sample if t is not None), torch.float32)
+    padded = torch.zeros(len(batch), max_len, hidden_size, dtype=dtype)
+    mask = torch.zeros((len(batch), max_len), dtype=torch.bool)
+    for i, (t, l) in enumerate(zip(per_sample, lengths)):
+        if l > 0:
+            padded[i, :l].copy_(t)
+            mask[i, :l] = True
+    return {key: padded, 'intention_mask': mask}
+
+
+def custom_collate(batch, intention_pad_multiple=8, intention_dtype=None, intention_hidden_size=None):
+    special = {key for key in batch[0] if key.startswith('intention_')}
+    stripped = [{k: v for k, v in item.items() if k not in special} for item in batch]
+    try:
+        # regular keys share shapes, so a single default_collate walks the dict once
+        batch_out = default_collate(stripped)
+    except Exception:
+        # some key is ragged; fall back to collating key by key
+        batch_out = {}
+        for key in stripped[0]:
+            try:
+                batch_out[key] = default_collate([item[key] for item in stripped])
+            except Exception:
+                batch_out[key] = [item[key] for item in stripped]
+
+    for key in special:
         if key == 'intention_embeddings':
-            cat_intentions = []
-            lengths = []
-            hidden_size = None
-            for sample in batch:
-                # sample[key] is a list of [seq_len, hidden] tensors
-                if len(sample[key]) == 0:
-                    # If no intentions, use a zero tensor of shape [1, hidden]
-                    # We'll infer hidden size from the first non-empty sample
-                    if hidden_size is None:
-                        # Find hidden size from any non-empty sample
-                        for s in batch:
-                            if len(s[key]) > 0:
-                                hidden_size = s[key][0].shape[1]
-                                break
-                        if hidden_size is None:
-                            hidden_size = 768  # fallback
-                    cat_intentions.append(torch.zeros(1, hidden_size))
-                    lengths.append(0)
-                else:
-                    concat = torch.cat(sample[key], dim=0)
-                    cat_intentions.append(concat)
-                    lengths.append(concat.shape[0])
-                    if hidden_size is None:
-                        hidden_size = concat.shape[1]
-            # Find max length in the batch
-            max_len = max(lengths) if lengths else 1
-            # Pad all to the same length
-            padded = pad_sequence(cat_intentions, batch_first=True)  # [batch, max_total_seq_len, hidden]
-            # Create mask: 1 for valid, 0 for padded
-            mask = torch.zeros((len(batch), max_len), dtype=torch.bool)
-            for i, l in enumerate(lengths):
-                if l > 0:
-                    mask[i, :l] = 1
-            batch_out[key] = padded
-            batch_out['intention_mask'] = mask
-        elif key.startswith('intention_'):
+            batch_out.update(collate_intentions_padded(batch, key, intention_pad_multiple, intention_dtype, intention_hidden_size))
+        else:
             # For texts and timings, keep as list of lists
             batch_out[key] = [item[key] for item in batch]
-        else:
-            try:
-                batch_out[key] = default_collate([item[key] for item in batch])
-            except Exception:
-                batch_out[key] = [item[key] for item in batch]
     return batch_out
 
 
+class CUDAPrefetcher(object):
+    """
+    Wrap a DataLoader so the next batch's host-to-device copy runs on a side CUDA stream
+    while the current step computes. Yields the same dicts, with tensors already on device.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        # keep DataLoader attributes used by the trainer (sampler.set_epoch, dataset, ...)
+        self.sampler = loader.sampler
+        self.dataset = loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self):
+        try:
+            batch = next(self.iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = {
+                k: v.to(self.device, non_blocking=True) if torch.is_tensor(v) else v
+                for k, v in batch.items()
+            }
+
+    def __iter__(self):
+        self.iter = iter(self.loader)
+        self._preload()
+        return self
+
+    def __next__(self):
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        # the tensors were allocated on the side stream but are consumed on the current one
+        for v in batch.values():
+            if torch.is_tensor(v):
+                v.record_stream(torch.cuda.current_stream(self.device))
+        self._preload()
+        return batch
+
+
+def _to_cpu(obj):
+    """
+    Detached, contiguous CPU copy of every tensor in a (nested) state dict, so training can keep
+    mutating the originals and safetensors accepts the result.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', memory_format=torch.contiguous_format, copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _write_checkpoint(checkpoint, paths, last_path=None):
+    """
+    Write model weights to model.safetensors and everything else to meta.pt in each directory,
+    and, if given, a minimal weights-only checkpoint (no optimizer/scheduler) to last_path
+    through an atomic rename.
+    """
+    tensors = checkpoint['model_state_dict']
+    meta = {k: v for k, v in checkpoint.items() if k != 'model_state_dict'}
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+        save_file(tensors, os.path.join(path, "model.safetensors"))
+        torch.save(meta, os.path.join(path, "meta.pt"), pickle_protocol=5)
+    if last_path is not None:
+        minimal = {k: v for k, v in checkpoint.items() if k not in ('optimizer_state_dict', 'scheduler_state_dict')}
+        torch.save(minimal, last_path + ".tmp", pickle_protocol=5)
+        os.replace(last_path + ".tmp", last_path)
+
+
+def load_checkpoint_file(path, map_location="cpu"):
+    """
+    Load a checkpoint dict from a model.safetensors + meta.pt directory, a directory holding
+    a legacy ckpt.pth, or a .pth file.
+    """
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, "model.safetensors")):
+            checkpoint = torch.load(os.path.join(path, "meta.pt"), map_location=map_location)
+            checkpoint['model_state_dict'] = load_file(os.path.join(path, "model.safetensors"), device=str(map_location))
+            return checkpoint
+        path = os.path.join(path, "ckpt.pth")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Checkpoint not found at {path}")
+    return torch.load(path, map_location=map_location)
+
+
 class BaseTrainer(object):
     def __init__(self, cfg, args):
         self.cfg = cfg
@@ -100,23 +202,75 @@ class BaseTrainer(object):
             "test_clip_fgd": {"value": float('inf'), "epoch": 0},
         }
               
-        self.train_data = init_class(cfg.data.name_pyfile, cfg.data.class_name, cfg.data, loader_type='train')
-        self.train_sampler = torch.utils.data.distributed.DistributedSampler(self.train_data)
-        self.train_loader = DataLoader(self.train_data, batch_size=cfg.data.train_bs, sampler=self.train_sampler, drop_last=True, num_workers=4, collate_fn=custom_collate)
+        # bf16 autocast for the training forward/backward, off by default
+        self.use_amp = cfg.solver.get('amp', False) and torch.cuda.is_available()
+              
+        # build split-independent resources (body model, split table) once and share them across splits
+        data_module = importlib.import_module(cfg.data.name_pyfile)
+        data_kwargs = {}
+        if hasattr(data_module, 'build_shared_store'):
+            data_kwargs['shared_store'] = data_module.build_shared_store(cfg.data)
+
+        sampler_needs_lengths = cfg.data.get('length_bucketing', False) or cfg.data.get('intention_packing', False)
+        self.train_data = self._init_split(cfg.data, 'train', with_lengths=sampler_needs_lengths, **data_kwargs)
+        # padded length is rounded up to intention_pad_multiple (8 for fp16, 16 for int8)
+        self.collate_fn = functools.partial(
+            custom_collate,
+            intention_pad_multiple=cfg.data.get('intention_pad_multiple', 8),
+            # source dtype by default; intention_dtype: bfloat16 re-rounds the fp16 rows and is opt-in
+            intention_dtype=getattr(torch, cfg.data.intention_dtype) if cfg.data.get('intention_dtype') else None,
+            # known per dataset, so collate never has to probe the tensors for it
+            intention_hidden_size=getattr(self.train_data, 'intention_hidden_size', None),
+        )
+        # pinned, persistent workers with deeper prefetch so H2D copies can be non_blocking
+        num_workers = min(8, os.cpu_count() or 1)
+        loader_kwargs = dict(pin_memory=True, persistent_workers=True, prefetch_factor=4)
+        if cfg.data.get('length_bucketing', False):
+            # group samples of similar intention length so the padded batches waste less attention
+            self.train_sampler = LengthBucketSampler(
+                self.train_data.get_intention_lengths(), cfg.data.train_bs,
+                bucket_mul=cfg.data.get('bucket_mul', 50), shuffle=True, drop_last=True,
+            )
+            self.train_loader = DataLoader(self.train_data, batch_sampler=self.train_sampler, num_workers=num_workers, collate_fn=self.collate_fn, **loader_kwargs)
+        elif cfg.data.get('intention_packing', False):
+            # variable-size batches holding at most max_pack_len padded intention tokens each
+            self.train_sampler = PackedIntentionBatchSampler(
+                self.train_data.get_intention_lengths(), max_pack_len=cfg.data.get('max_pack_len', 2048),
+                max_batch_size=cfg.data.train_bs, pad_multiple=cfg.data.get('intention_pad_multiple', 8),
+            )
+            self.train_loader = DataLoader(self.train_data, batch_sampler=self.train_sampler, num_workers=num_workers, collate_fn=self.collate_fn, **loader_kwargs)
+        else:
+            self.train_sampler = torch.utils.data.distributed.DistributedSampler(self.train_data)
+            self.train_loader = DataLoader(self.train_data, batch_size=cfg.data.train_bs, sampler=self.train_sampler, drop_last=True, num_workers=num_workers, collate_fn=self.collate_fn, **loader_kwargs)
+        if torch.cuda.is_available():
+            # overlap the train H2D copies with compute; the bs=1 test loader is not worth it
+            self.train_loader = CUDAPrefetcher(self.train_loader, device=self.rank)
         
         if cfg.data.test_clip:
             # test data for test_clip, only used for test_clip_fgd
-            self.test_clip_data = init_class(cfg.data.name_pyfile, cfg.data.class_name, cfg.data, loader_type='test')
-            self.test_clip_loader = DataLoader(self.test_clip_data, batch_size=128, drop_last=False, num_workers=4, collate_fn=custom_collate)
+            self.test_clip_data = self._init_split(cfg.data, 'test', **data_kwargs)
+            self.test_clip_loader = DataLoader(self.test_clip_data, batch_size=128, drop_last=False, num_workers=num_workers, collate_fn=self.collate_fn, **loader_kwargs)
         
         # test data for fgd, l1div and bc
         test_data_cfg = cfg.data.copy()
         test_data_cfg.test_clip = False
-        self.test_data = init_class(cfg.data.name_pyfile, cfg.data.class_name, test_data_cfg, loader_type='test')
-        self.test_loader = DataLoader(self.test_data, batch_size=1, drop_last=False, collate_fn=custom_collate)
+        self.test_data = self._init_split(test_data_cfg, 'test', **data_kwargs)
+        # one whole sequence per batch: the VQ encoder/decoder have no padding mask, so padded batches change the metrics
+        self.test_loader = DataLoader(self.test_data, batch_size=1, drop_last=False, num_workers=2, collate_fn=self.collate_fn, pin_memory=True, persistent_workers=True)
+        # validation is sharded across ranks under DDP; strided, unpadded shards so no sequence is
+        # counted twice, and val() reduces the per-rank metric sums afterwards
+        if cfg.ddp and dist.is_initialized() and dist.get_world_size() > 1:
+            self.val_indices = list(range(dist.get_rank(), len(self.test_data), dist.get_world_size()))
+            self.val_loader = DataLoader(torch.utils.data.Subset(self.test_data, self.val_indices), batch_size=1, drop_last=False, num_workers=2, collate_fn=self.collate_fn, pin_memory=True, persistent_workers=True)
+        else:
+            self.val_indices = list(range(len(self.test_data)))
+            self.val_loader = self.test_loader
         
         
+        # batches per epoch; the packed sampler's count changes with each epoch's bins, see start_epoch
         self.train_length = len(self.train_loader)
+        # training iterations finished before the current epoch, the step used for logging and checkpoints
+        self.global_step = 0
         logger.info(f"Init train andtest dataloader successfully")
         
         
@@ -146,12 +300,28 @@ class BaseTrainer(object):
         eval_args.vae_grow = [1,1,2,1]
         
         eval_copy = getattr(eval_model_module, 'VAESKConv')(eval_args).to(self.rank)
+        eval_ckpt_path = './datasets/BEAT_SMPL/beat_v2.0.0/beat_english_v2.0.0/weights/AESKConv_240_100.bin'
+        # read the FGD encoder weights from disk once on rank 0 and broadcast them to the other ranks
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            eval_states = [torch.load(eval_ckpt_path, map_location='cpu') if dist.get_rank() == 0 else None]
+            dist.broadcast_object_list(eval_states, src=0)
+            eval_states = eval_states[0]
+        else:
+            eval_states = None
         other_tools.load_checkpoints(
             eval_copy, 
-            './datasets/BEAT_SMPL/beat_v2.0.0/beat_english_v2.0.0/weights/AESKConv_240_100.bin', 
-            'VAESKConv'
+            eval_ckpt_path, 
+            'VAESKConv',
+            states=eval_states,
         )
-        self.eval_copy = eval_copy
+        # float32 by default so FGD stays comparable with published numbers; eval_dtype: bfloat16 is an
+        # opt-in speedup for quick checks. map2latent is compiled with dynamic shapes since every test
+        # sequence has a different length
+        self.eval_dtype = getattr(torch, cfg.get('eval_dtype', 'float32'))
+        self.eval_copy = eval_copy.to(self.eval_dtype).eval()
+        self._eval_map2latent = self.eval_copy.map2latent
+        if cfg.get('compile_eval', False):
+            self._eval_map2latent = torch.compile(self.eval_copy.map2latent, dynamic=True)
         
         
         self.smplx = smplx.create(
@@ -169,6 +339,33 @@ class BaseTrainer(object):
         self.align_mask = 60
         self.l1_calculator = metric.L1div() if self.rank == 0 else None
 
+    def _init_split(self, data_cfg, loader_type, with_lengths=False, **data_kwargs):
+        """
+        Build one dataset split. Under torch.distributed, rank 0 builds the cache and loads the
+        sample index, then broadcasts it, so the other ranks skip the scan (the broadcast also keeps
+        them from reading a cache rank 0 is still writing)
+        """
+        dataset_class = getattr(importlib.import_module(data_cfg.name_pyfile), data_cfg.class_name)
+        if not (dist.is_initialized() and dist.get_world_size() > 1 and hasattr(dataset_class, 'export_index')):
+            return init_class(data_cfg.name_pyfile, data_cfg.class_name, data_cfg, loader_type=loader_type, **data_kwargs)
+
+        dataset, index = None, [None]
+        if dist.get_rank() == 0:
+            dataset = dataset_class(data_cfg, loader_type=loader_type, **data_kwargs)
+            index = [dataset.export_index(with_lengths=with_lengths)]
+        dist.broadcast_object_list(index, src=0)
+        if dataset is None:
+            dataset = dataset_class(data_cfg, loader_type=loader_type, build_cache=False, prebuilt_index=index[0], **data_kwargs)
+        return dataset
+
+    def eval_map2latent(self, pose):
+        """FGD latents of a pose sequence, computed in eval_dtype and returned as float32."""
+        return self._eval_map2latent(pose.to(self.eval_dtype)).float()
+
+    def start_epoch(self, epoch):
+        """Recount the batches of this epoch once the sampler has its epoch set."""
+        self.train_length = len(self.train_loader)
+
     def train_recording(self, epoch, its, t_data, t_train, mem_cost, lr_g, lr_d=None):
         """Enhanced training metrics logging"""
         metrics = {}
@@ -190,8 +387,9 @@ class BaseTrainer(object):
         })
         
 
-        # Log all metrics at once if using wandb
-        wandb.log(metrics, step=epoch*self.train_length+its)
+        # Log all metrics at once if using wandb; this commits the step, together with any
+        # validation metrics val_recording left pending on it
+        wandb.log(metrics, step=self.global_step+its)
 
         # Print progress
         pstr = f"[{epoch:03d}][{its:03d}/{self.train_length:03d}]  "
@@ -199,15 +397,18 @@ class BaseTrainer(object):
         logger.info(pstr)
 
 
-    def val_recording(self, epoch):
+    def val_recording(self, epoch, iteration=None):
         """Enhanced validation metrics logging"""
+        if iteration is None:
+            iteration = self.global_step
         metrics = {}
+        improved = []
         
         # Process all validation metrics
         for name, states in self.tracker.loss_meters.items():
             metric = states['val']
             if metric.count > 0:
-                value = float(metric.avg) if metric.count > 0 else float(metric.sum)
+                value = metric.avg
                 metrics[f"val/{name}"] = value
                 
                 # Compare with best values to track best performance
@@ -222,34 +423,29 @@ class BaseTrainer(object):
                         is_better = value < current_best  # Default: lower is better
 
                     if is_better:
+                        # plain python numbers, so val_best stays loadable from the checkpoint metadata
                         self.val_best[name] = {
                             "value": float(value),
                             "epoch": int(epoch)
                         }
-                        
-                        # Save best checkpoint separately
-                        self.save_checkpoint(
-                            epoch=epoch,
-                            iteration=epoch * len(self.train_loader),
-                            is_best=True,
-                            best_metric_name=name
-                        )
+                        improved.append(name)
                     
                     # Add best value to metrics
-                    metrics[f"best_{name}"] = float(self.val_best[name]["value"])
-                    metrics[f"best_{name}_epoch"] = int(self.val_best[name]["epoch"])
+                    metrics[f"best_{name}"] = self.val_best[name]["value"]
+                    metrics[f"best_{name}_epoch"] = self.val_best[name]["epoch"]
 
-        # Always save regular checkpoint for every validation
+        # One checkpoint write per validation: the periodic one and/or a single best shared by all improved metrics
         self.save_checkpoint(
             epoch=epoch,
-            iteration=epoch * len(self.train_loader),
-            is_best=False,
-            best_metric_name=None
+            iteration=iteration,
+            is_best=bool(improved),
+            best_metric_names=improved
         )
 
-        # Log metrics
+        # Log metrics; validation runs at the step the next epoch's its=0 train log commits, so leave
+        # the row open and let that (or wandb.finish after the last epoch) commit both in one go
         if self.rank == 0:
-            wandb.log(metrics, step=epoch*len(self.train_loader))
+            wandb.log(metrics, step=iteration, commit=False)
         
         # Print validation results
         pstr = "Validation Results >>>> "
@@ -272,34 +468,89 @@ class BaseTrainer(object):
         self.tracker.update_meter(dict_name, "test", value)
         _ = self.tracker.update_values(dict_name, 'test', epoch)
 
-    def save_checkpoint(self, epoch, iteration, is_best=False, best_metric_name=None):
+    def save_checkpoint(self, epoch, iteration, is_best=False, best_metric_names=()):
         """Save training checkpoint
         Args:
             epoch (int): Current epoch number
             iteration (int): Current iteration number
-            is_best (bool): Whether this is the best model so far
-            best_metric_name (str, optional): Name of the metric if this is a best checkpoint
+            is_best (bool): Whether this is the best model so far for some metric
+            best_metric_names (list, optional): Metrics that improved; each best_{name} is linked to
+                the single best_epoch_{epoch} checkpoint written for all of them
+        Every call refreshes the weights-only last.pth; optimizer and scheduler state are only
+        written with the periodic and best checkpoints.
         """
+        paths = []
+        # Save regular checkpoint every 20 epochs
+        if epoch % 20 == 0:
+            paths.append(os.path.join(self.checkpoint_path, f"checkpoint_{epoch}"))
+        # Save best checkpoint once, however many metrics improved
+        best_path = None
+        if is_best and best_metric_names:
+            best_path = os.path.join(self.checkpoint_path, f"best_epoch_{epoch}")
+            paths.append(best_path)
+        # snapshot to CPU on this thread, then let a background thread do the disk writes
         checkpoint = {
             'epoch': epoch,
             'iteration': iteration,
             'model_state_dict': self.model.state_dict(),
-            'optimizer_state_dict': self.opt.state_dict(),
-            'scheduler_state_dict': self.opt_s.state_dict() if hasattr(self, 'opt_s') and self.opt_s else None,
-            'val_best': self.val_best,
+            'val_best': copy.deepcopy(self.val_best),
         }
-        
-        # Save regular checkpoint every 20 epochs
-        if epoch % 20 == 0:
-            checkpoint_path = os.path.join(self.checkpoint_path, f"checkpoint_{epoch}")
-            os.makedirs(checkpoint_path, exist_ok=True)
-            torch.save(checkpoint, os.path.join(checkpoint_path, "ckpt.pth"))
-        
-        # Save best checkpoint if specified
-        if is_best and best_metric_name:
-            best_path = os.path.join(self.checkpoint_path, f"best_{best_metric_name}")
-            os.makedirs(best_path, exist_ok=True)
-            torch.save(checkpoint, os.path.join(best_path, "ckpt.pth"))
+        if paths:
+            checkpoint['optimizer_state_dict'] = self.opt.state_dict()
+            checkpoint['scheduler_state_dict'] = self.opt_s.state_dict() if hasattr(self, 'opt_s') and self.opt_s else None
+        checkpoint = _to_cpu(checkpoint)
+        # single slot: never let two saves overlap
+        self.wait_for_checkpoint()
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+        self._save_thread = threading.Thread(
+            target=self._write_checkpoint_bg, args=(checkpoint, paths, os.path.join(self.checkpoint_path, "last.pth")),
+            daemon=True)
+        self._save_thread.start()
+
+        if best_path is not None:
+            self._link_best(best_path, best_metric_names)
+
+    def _link_best(self, best_path, metric_names):
+        """Point best_{name} at best_path for each metric and drop best_epoch_* dirs nothing links to."""
+        for name in metric_names:
+            link = os.path.join(self.checkpoint_path, f"best_{name}")
+            if os.path.isdir(link) and not os.path.islink(link):
+                shutil.rmtree(link)  # legacy per-metric copy
+            tmp_link = link + ".tmp"
+            if os.path.lexists(tmp_link):
+                os.remove(tmp_link)
+            os.symlink(os.path.basename(best_path), tmp_link)
+            os.replace(tmp_link, link)
+
+        linked = {
+            os.path.realpath(os.path.join(self.checkpoint_path, f"best_{name}"))
+            for name in self.val_best
+            if os.path.islink(os.path.join(self.checkpoint_path, f"best_{name}"))
+        }
+        for stale in glob.glob(os.path.join(self.checkpoint_path, "best_epoch_*")):
+            if os.path.realpath(stale) not in linked:
+                shutil.rmtree(stale, ignore_errors=True)
+
+    def _write_checkpoint_bg(self, *args):
+        # an exception would otherwise die with the thread; keep it for wait_for_checkpoint to raise
+        try:
+            _write_checkpoint(*args)
+        except BaseException as e:
+            self._save_error = e
+
+    def wait_for_checkpoint(self):
+        """
+        Block until the in-flight background checkpoint write, if any, has finished, and re-raise
+        the error it failed with.
+        """
+        save_thread = getattr(self, '_save_thread', None)
+        if save_thread is not None:
+            save_thread.join()
+            self._save_thread = None
+        save_error = getattr(self, '_save_error', None)
+        if save_error is not None:
+            self._save_error = None
+            raise RuntimeError("Background checkpoint write failed") from save_error
 
 def prepare_all():
     """
@@ -369,39 +620,63 @@ def prepare_all():
     with open(config_path, 'w') as f:
         OmegaConf.save(cfg, f)
 
-    # Copy source files for reproducibility
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    sanity_check_dir = os.path.join(save_dir, 'sanity_check')
-    output_dir = os.path.abspath(cfg.output_dir)
+    # Copy source files for reproducibility (training runs only)
+    if args.mode == 'train' and not args.debug:
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        sanity_check_dir = os.path.join(save_dir, 'sanity_check')
+        output_dir = os.path.abspath(cfg.output_dir)
     
-    def is_in_output_dir(path):
-        return os.path.abspath(path).startswith(output_dir)
+        def is_in_output_dir(path):
+            return os.path.abspath(path).startswith(output_dir)
     
-    def should_copy_file(file_path):
-        if is_in_output_dir(file_path):
-            return False
-        if '__pycache__' in file_path:
-            return False
-        if file_path.endswith('.pyc'):
-            return False
-        return True
-
-    # Copy Python files
-    for root, dirs, files in os.walk(current_dir):
-        if is_in_output_dir(root):
-            continue
+        def should_copy_file(file_path):
+            if is_in_output_dir(file_path):
+                return False
+            if '__pycache__' in file_path:
+                return False
+            if file_path.endswith('.pyc'):
+                return False
+            return True
+
+        def copy_source(full_file_path):
+            relative_path = os.path.relpath(full_file_path, current_dir)
+            dest_path = os.path.join(sanity_check_dir, relative_path)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            try:
+                shutil.copy(full_file_path, dest_path)
+            except Exception as e:
+                print(f"Warning: Could not copy {full_file_path}: {str(e)}")
+
+        # one `git archive` of this directory (+ the uncommitted diff, + untracked .py files copied
+        # one by one) instead of copying every .py file
+        archived = False
+        try:
+            result = subprocess.run(['git', 'archive', '--format=tar', '-o', os.path.join(sanity_check_dir, 'code.tar'), 'HEAD', '--', '.'],
+                                    cwd=current_dir, capture_output=True, check=False)
+            archived = result.returncode == 0
+            if archived:
+                with open(os.path.join(sanity_check_dir, 'code.diff'), 'wb') as f:
+                    subprocess.run(['git', 'diff', 'HEAD', '--', '.'], cwd=current_dir, stdout=f, check=False)
+                untracked = subprocess.run(['git', 'ls-files', '-z', '--others', '--exclude-standard', '--', '.'],
+                                           cwd=current_dir, capture_output=True, check=False).stdout
+                for relative_path in untracked.decode().split('\0'):
+                    full_file_path = os.path.join(current_dir, relative_path)
+                    if relative_path.endswith(".py") and should_copy_file(full_file_path):
+                        copy_source(full_file_path)
+        except OSError:
+            pass
+
+        if not archived:
+            # Copy Python files
+            for root, dirs, files in os.walk(current_dir):
+                if is_in_output_dir(root):
+                    continue
             
-        for file in files:
-            if file.endswith(".py"):
-                full_file_path = os.path.join(root, file)
-                if should_copy_file(full_file_path):
-                    relative_path = os.path.relpath(full_file_path, current_dir)
-                    dest_path = os.path.join(sanity_check_dir, relative_path)
-                    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                    try:
-                        shutil.copy(full_file_path, dest_path)
-                    except Exception as e:
-                        print(f"Warning: Could not copy {full_file_path}: {str(e)}")
+                for file in files:
+                    if file.endswith(".py"):
+                        full_file_path = os.path.join(root, file)
+                        if should_copy_file(full_file_path):
+                            copy_source(full_file_path)
     
     return cfg, args
 
@@ -440,17 +715,12 @@ def main_worker(rank, world_size, cfg, args):
     # Resume logic
     resume_epoch = 0
     if args.resume:
-        # Find the checkpoint path
-        if os.path.isdir(args.resume):
-            ckpt_path = os.path.join(args.resume, "ckpt.pth")
-        else:
-            ckpt_path = args.resume
-        if not os.path.exists(ckpt_path):
-            raise FileNotFoundError(f"Checkpoint not found at {ckpt_path}")
-        checkpoint = torch.load(ckpt_path, map_location="cpu")
+        checkpoint = load_checkpoint_file(args.resume, map_location="cpu")
         trainer.load_checkpoint(checkpoint)
         resume_epoch = checkpoint.get('epoch', 0) + 1  # Start from next epoch
-        logger.info(f"Resumed from checkpoint {ckpt_path}, starting at epoch {resume_epoch}")
+        # per-epoch batch counts of the skipped epochs are not stored; estimate them with the current one
+        trainer.global_step = resume_epoch * trainer.train_length
+        logger.info(f"Resumed from checkpoint {args.resume}, starting at epoch {resume_epoch}")
     
     if args.mode == "train" and not args.resume:
         logger.info("Training from scratch ...")
@@ -464,16 +734,19 @@ def main_worker(rank, world_size, cfg, args):
     if args.mode == "train":
         start_time = time.time()
         for epoch in range(resume_epoch, cfg.solver.epochs+1):
-            if cfg.ddp: 
-                trainer.val_loader.sampler.set_epoch(epoch)
+            val_sampler = getattr(trainer.val_loader, 'sampler', None)
+            if cfg.ddp and hasattr(val_sampler, 'set_epoch'):
+                val_sampler.set_epoch(epoch)
             
             
             if (epoch) % cfg.val_period == 0 and epoch > 0:
-                if rank == 0:
-                    if cfg.data.test_clip:
-                        trainer.test_clip(epoch)
-                    else:
-                        trainer.val(epoch)
+                iteration = trainer.global_step
+                if cfg.data.test_clip:
+                    if rank == 0:
+                        trainer.test_clip(epoch, iteration)
+                elif cfg.ddp or rank == 0:
+                    # every rank validates its own shard under DDP
+                    trainer.val(epoch, iteration)
             
             epoch_time = time.time()-start_time
             if trainer.rank == 0: 
@@ -482,9 +755,11 @@ def main_worker(rank, world_size, cfg, args):
             
             if epoch != cfg.solver.epochs:
                 if cfg.ddp: 
-                    trainer.train_loader.sampler.set_epoch(epoch)
+                    trainer.train_sampler.set_epoch(epoch)
+                trainer.start_epoch(epoch)
                 trainer.tracker.reset()
                 trainer.train(epoch)
+                trainer.global_step += trainer.train_length
                 
             if cfg.debug:
                 trainer.test(epoch)
@@ -492,6 +767,7 @@ def main_worker(rank, world_size, cfg, args):
             
         
         # Final cleanup and logging
+        trainer.wait_for_checkpoint()
         if rank == 0:
             for k, v in trainer.val_best.items():
                 logger.info(f"Best {k}: {v['value']:.6f} at epoch {v['epoch']}")
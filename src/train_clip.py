@@ -403,7 +403,8 @@ def custom_collate(batch):
                     cat_intentions.append(torch.zeros(1, hidden_size))
                     lengths.append(0)
                 else:
-                    concat = torch.cat(sample[key], dim=0)
+                    # fp16 when the dataset reads the intention memmap; this model runs in float32
+                    concat = torch.cat(sample[key], dim=0).float()
                     cat_intentions.append(concat)
                     lengths.append(concat.shape[0])
                     if hidden_size is None:
@@ -774,8 +774,10 @@ def save_checkpoints(save_path, model, opt=None, epoch=None, lrs=None):
         states = { 'model_state': model_state_dict,}
     torch.save(states, save_path)
 
-def load_checkpoints(model, save_path, load_name='model'):
-    states = torch.load(save_path)
+def load_checkpoints(model, save_path, load_name='model', states=None):
+    # states: an already loaded checkpoint dict (e.g. broadcast from rank 0), skips the disk read
+    if states is None:
+        states = torch.load(save_path)
     new_weights = OrderedDict()
     flag=False
     for k, v in states['model_state'].items():